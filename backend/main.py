@@ -1,52 +1,256 @@
+import os
+import hmac
+import time
 import base64
-from services.getfeatures import get_features
-from services.getmood import get_mood
-from services.visualization import visualize_emotion
+import asyncio
+import zipfile
+import numpy as np
+from io import BytesIO
+from functools import partial
+from typing import Literal
+from contextlib import asynccontextmanager
+from services.getfeatures import FeatureSchemaError, decode_audio, decode_rate, get_features
+from services.getmood import ModelLoadError, ModelTierError, ModelVersionError, get_mood, get_moods, load_models, registry
+from services.visualization import visualize_emotion, visualize_trajectory, plot_id, render_plot, load_base_graph, render_cache_info
+from services.timeline import TIMELINE_HOP, TIMELINE_MAX_SECONDS, TIMELINE_WINDOW, get_timeline
+from services.streaming import (
+    STREAM_HALFLIFE, STREAM_INTERVAL, STREAM_MAX_CHUNK_BYTES, STREAM_MAX_CONNECTIONS, STREAM_QUEUE_CHUNKS,
+    STREAM_SEND_TIMEOUT, STREAM_TIER, EncodedDecoder, PcmDecoder, StreamAnalyzer
+)
 from services.organizedata import organize_data, Emotion
-from pydantic import BaseModel
-from fastapi import FastAPI, File, HTTPException, UploadFile
+from services.cache import ResultCache, audio_key
+from services.vectorstore import VECTOR_STORE_DIR, VectorStore, song_id
+from services.admission import admit, decoded_header, job_cost
+from services.pool import AnalysisPool, PoolFull, PoolTimeout, RETRY_AFTER
+from services import metrics
+from pydantic import BaseModel, Field
+from fastapi import FastAPI, File, HTTPException, Query, Request, Response, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 500))
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 50 * 1024 * 1024))
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', 500 * 1024 * 1024))  # a batch's uploads, zips counted expanded
+PLOT_MAX_AGE = int(os.environ.get('PLOT_MAX_AGE', 7 * 24 * 3600))
+# 'background' serves health right away and loads models and the base graph in a thread,
+# 'eager' loads them before serving, 'lazy' on first use. Workers always warm up at start
+STARTUP_MODES = ('eager', 'background', 'lazy')
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'background')
+if STARTUP_MODE not in STARTUP_MODES:
+    raise ValueError(f"STARTUP_MODE={STARTUP_MODE!r} is not one of {STARTUP_MODES}")
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # unset turns the /admin endpoints off
 
 class Result(BaseModel):
-    image: str  # base64-encoded PNG
+    id: str | None = None  # the song's ID in the vector store, for GET /similar/{id}
+    degraded: list[Literal['image', 'window', 'tier']] | None = None  # what was given up under load
+    modelVersion: str | None = None  # version@artifact fingerprint of the models that answered
+    image: str | None = None  # base64-encoded PNG, with ?image=inline
+    imageUrl: str | None = None  # GET /plot/{id} link, with ?image=url
     emotion1: Emotion
     emotion2: Emotion | None = None
     emotion3: Emotion | None = None
 
-def main(audio_file):
-    features = get_features(audio_file)
-    mood = get_mood(features)
+class BatchItem(BaseModel):
+    filename: str
+    id: str | None = None
+    valence: float | None = None
+    arousal: float | None = None
+    emotion1: Emotion | None = None
+    emotion2: Emotion | None = None
+    emotion3: Emotion | None = None
+    error: str | None = None
 
-    if mood is None:
-        return None
+class BatchResult(BaseModel):
+    modelVersion: str
+    results: list[BatchItem]
+
+class TimelinePoint(BaseModel):
+    start: float  # seconds
+    end: float
+    valence: float
+    arousal: float
+    emotion1: Emotion
+    emotion2: Emotion | None = None
+    emotion3: Emotion | None = None
+
+class TimelineResult(BaseModel):
+    duration: float  # seconds analyzed, at most TIMELINE_MAX_SECONDS
+    points: list[TimelinePoint]
+    image: str | None = None  # base64-encoded trajectory plot, with ?image=inline
+    modelVersion: str | None = None
 
-    image_buf = visualize_emotion(mood.valence, mood.arousal)
-    image = base64.b64encode(image_buf.read()).decode('utf-8')
+class Neighbor(BaseModel):
+    id: str
+    name: str | None = None  # upload filename or catalog path
+    distance: float
+    valence: float
+    arousal: float
 
+class SimilarResult(BaseModel):
+    space: Literal['features', 'mood']
+    neighbors: list[Neighbor]
+
+# a raw full-tier feature vector, or a point in valence/arousal space
+class SimilarQuery(BaseModel):
+    features: list[float] | None = None
+    valence: float | None = Field(None, ge=0, le=1)
+    arousal: float | None = Field(None, ge=0, le=1)
+    k: int = Field(10, ge=1, le=1000)
+
+# A/B weights per model version, e.g. {"default": 90, "candidate": 10}
+class ModelSplit(BaseModel):
+    weights: dict[str, float]
+
+# emotions 2 and 3 are only reported when they're above 5%
+def top_emotions(mood):
+    emotions = {"emotion1": organize_data(mood.emotion1, mood.percentage1)}
     if mood.percentage2 > 5:
+        emotions["emotion2"] = organize_data(mood.emotion2, mood.percentage2)
         if mood.percentage3 > 5:
-            return Result(
-                image=image,
-                emotion1=organize_data(mood.emotion1, mood.percentage1),
-                emotion2=organize_data(mood.emotion2, mood.percentage2),
-                emotion3=organize_data(mood.emotion3, mood.percentage3)
-            )
-        return Result(
-            image=image,
-            emotion1=organize_data(mood.emotion1, mood.percentage1),
-            emotion2=organize_data(mood.emotion2, mood.percentage2)
-        )
+            emotions["emotion3"] = organize_data(mood.emotion3, mood.percentage3)
+    return emotions
 
-    return Result(
-        image=image,
-        emotion1=organize_data(mood.emotion1, mood.percentage1)
-    )
+# image is 'inline' (base64 in the response), 'url' (a /plot link) or 'none' (no plot);
+# tier is the feature tier, 'fast' skips the HPSS and tonnetz features; model is the
+# (version, fingerprint) the server picked, the default version when None. With with_vector
+# returns (result, (features, valence, arousal)) so the server can keep the vector
+def main(audio_file, image='inline', tier='full', with_vector=False, model=None):
+    models = registry.get(*model) if model else registry.get()
+    features = get_features(audio_file, tier=tier)
+    mood = get_mood(features, tier, models)
+
+    if mood is None:
+        return (None, None) if with_vector else None
+
+    if image == 'url':
+        # nothing is rendered here, GET /plot renders on demand
+        result = Result(imageUrl=f"/plot/{plot_id(mood.valence, mood.arousal)}", **top_emotions(mood))
+    elif image == 'none':
+        result = Result(**top_emotions(mood))
+    else:
+        image_buf = visualize_emotion(mood.valence, mood.arousal)
+        with metrics.span('encode'):
+            image = base64.b64encode(image_buf.read()).decode('utf-8')
+        result = Result(image=image, **top_emotions(mood))
+
+    result.modelVersion = models.label
+    return (result, (features[0], mood.valence, mood.arousal)) if with_vector else result
+
+# extracts a chunk of uploads in a worker, decoding each once for both its features and
+# its audio key, the vector store's song ID
+def extract_batch(audio_files, tier='full'):
+    extracted = []
+    for audio_file in audio_files:
+        try:
+            audio = decode_audio(audio_file, 45, decode_rate())
+        except Exception as e:
+            print(f"Audio decoding failed: {e}")
+            extracted.append((None, None))
+            continue
+        extracted.append((get_features(audio, tier=tier), audio_key(audio)))
+    return extracted
 
-app = FastAPI()
+# mood of every window across the whole track, runs in a pool worker like main
+def timeline(audio_file, window=TIMELINE_WINDOW, hop=TIMELINE_HOP, image='inline', tier='full', model=None):
+    models = registry.get(*model) if model else registry.get()
+    extracted = get_timeline(audio_file, window=window, hop=hop, tier=tier)
+    if extracted is None:
+        return None
+
+    starts, ends, features = extracted
+    moods = get_moods(features, tier, models)
+    points = [
+        TimelinePoint(start=round(start, 3), end=round(end, 3), valence=mood.valence, arousal=mood.arousal,
+                      **top_emotions(mood))
+        for start, end, mood in zip(starts, ends, moods)
+    ]
+
+    result = TimelineResult(duration=round(ends[-1], 3), points=points, modelVersion=models.label)
+    if image == 'inline':
+        image_buf = visualize_trajectory([(mood.valence, mood.arousal) for mood in moods])
+        with metrics.span('encode'):
+            result.image = base64.b64encode(image_buf.read()).decode('utf-8')
+    return result
+
+pool = AnalysisPool()
+# both opened by the server at startup, never by pool workers importing this module. Only
+# full-tier vectors are kept, so every stored vector lives in the same space
+cache = None
+vectors = None
+streams = 0  # open /analyze/stream connections
+admissions = {'degraded': 0, 'shed': 0}
+
+metrics.gauge('mood_pool_pending', 'Analysis jobs running or queued', lambda: pool.pending)
+metrics.gauge('mood_pool_capacity', 'Jobs the pool accepts before answering 503', lambda: pool.capacity)
+metrics.gauge('mood_pool_workers', 'Analysis worker processes', lambda: pool.workers)
+metrics.gauge('mood_pool_backlog_seconds', 'Estimated seconds of queued work per worker', lambda: pool.backlog)
+metrics.gauge('mood_pool_cost_scale', 'Measured / estimated analysis job time', lambda: pool.scale)
+metrics.gauge('mood_admission_degraded_total', 'Requests served degraded under load',
+              lambda: admissions['degraded'], kind='counter')
+metrics.gauge('mood_admission_shed_total', 'Requests refused because even a degraded analysis would be late',
+              lambda: admissions['shed'], kind='counter')
+metrics.gauge('mood_cache_hits_total', 'Result cache hits', lambda: cache.stats()['hits'] if cache else 0, kind='counter')
+metrics.gauge('mood_cache_misses_total', 'Result cache misses', lambda: cache.stats()['misses'] if cache else 0,
+              kind='counter')
+metrics.gauge('mood_cache_hit_ratio', 'Result cache hits / lookups', lambda: cache.stats()['hit_rate'] if cache else 0.0)
+metrics.gauge('mood_cache_entries', 'Results held in the in-memory cache', lambda: cache.stats()['entries'] if cache else 0)
+metrics.gauge('mood_vector_store_songs', 'Songs in the vector store', lambda: len(vectors) if vectors else 0)
+metrics.gauge('mood_stream_connections', 'Open /analyze/stream connections', lambda: streams)
+metrics.gauge('mood_render_cache_hits_total', 'Memoized plot renders served',
+              lambda: render_cache_info().hits, kind='counter')
+metrics.gauge('mood_render_cache_misses_total', 'Plots rendered', lambda: render_cache_info().misses, kind='counter')
 
+# what the server process itself uses, for batch scoring and /plot
+def load_components():
+    load_models()
+    load_base_graph()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global cache, vectors
+    cache = ResultCache()
+    if VECTOR_STORE_DIR:
+        vectors = VectorStore(VECTOR_STORE_DIR)
+    pool.start()
+    loading = None
+    if STARTUP_MODE == 'eager':
+        load_components()
+    elif STARTUP_MODE == 'background':
+        # a request that arrives first just loads what it needs itself, under the same lock
+        loading = asyncio.create_task(run_in_threadpool(load_components))
+    yield
+    if loading is not None:
+        await loading
+    pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# answers as soon as the server is up; ready turns true once the workers have warmed up
 @app.get("/")
 def health():
-    return {"status": "ok"}
+    return {"status": "ok", "ready": pool.ready}
+
+# every request gets a trace: its stages (including those timed inside pool workers) feed
+# the histograms on /metrics and one JSON log line
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    trace = metrics.start_trace()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        # route templates keep label cardinality bounded, /plot/{plot_id} rather than every id
+        path = route.path if route is not None else 'unmatched'
+        metrics.finish_request(trace, request.method, path, status, time.perf_counter() - start)
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 app.add_middleware(
     CORSMiddleware,
@@ -56,14 +260,479 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/analyze", response_model=Result)
-async def analyze(file: UploadFile = File(...)):
-    audio_bytes = await file.read()
-    print(f"[DEBUG] Received file: {file.filename}, size: {len(audio_bytes)} bytes")
-    result = main(audio_bytes)
-    print(f"[DEBUG] Result: {result.emotion1.name if result else 'None'}")
+def server_busy():
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, try again shortly",
+        headers={"Retry-After": str(RETRY_AFTER)}
+    )
+
+# CPU-bound work runs in the process pool so the event loop keeps serving; `cost` is the
+# job's estimated seconds, cheaper jobs get a worker first
+async def run_in_pool(fn, *args, cost=None, job=None, timeout=None):
+    try:
+        return await pool.run(fn, *args, cost=cost, job=job, timeout=timeout)
+    except PoolFull:
+        raise server_busy()
+    except PoolTimeout:
+        raise HTTPException(status_code=504, detail="Audio analysis timed out")
+    except ModelLoadError:
+        # the worker caught the model files mid-change, the next try finds them settled
+        raise HTTPException(
+            status_code=503,
+            detail="Models are being updated, try again shortly",
+            headers={"Retry-After": str(RETRY_AFTER)}
+        )
+
+# the ModelSet that answers a request: ?model= when given, otherwise one drawn by the A/B
+# split, always the same one for the same audio key. Pool jobs get its (version, fingerprint)
+async def pick_model(requested, key=None):
+    try:
+        version = registry.choose(requested, key)
+        models = await run_in_threadpool(registry.get, version)
+    except ModelVersionError as e:
+        raise HTTPException(status_code=422, detail=f"{e}, available: {', '.join(registry.versions())}")
+    metrics.annotate(model=models.label)
+    return models
+
+def require_tier(models, tier):
+    try:
+        models.require(tier)
+    except ModelTierError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+def check_upload_size(file):
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Uploads are limited to {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+        )
+
+# decodes just the analysis window straight from the spooled upload instead of reading it all
+async def decode_upload(file, duration=45):
+    try:
+        return await run_in_threadpool(decode_audio, file.file, duration, decode_rate())
+    except Exception as e:
+        print(f"Audio decoding failed: {e}")
+        return None
+
+@app.post("/analyze", response_model=Result, response_model_exclude_none=True)
+async def analyze(
+    request: Request,
+    file: UploadFile = File(...),
+    image: Literal['inline', 'url', 'none'] = Query('inline'),
+    tier: Literal['full', 'fast'] = Query('full'),
+    model: str | None = Query(None, description="model version, default: by the A/B split")
+):
+    check_upload_size(file)
+    metrics.annotate(filename=file.filename, bytes=file.size)
+    if model is not None:
+        await pick_model(model)  # an unknown version fails before any work
+
+    audio = await decode_upload(file)
+    if audio is None:
+        raise HTTPException(status_code=400, detail="Unable to detect mood from audio")
+    key = await run_in_threadpool(audio_key, audio)
+    models = await pick_model(model, key)
+    require_tier(models, tier)
+    # the requested tier and image and the model version make the cache key, so a repeat is
+    # answered before admission control, however loaded the pool is
+    cache_key = f"{key}:{tier}:{image}:{models.label}" if key else None
+    # with RESULT_CACHE_DB set, get and put are SQLite round trips
+    cached = await run_in_threadpool(cache.get, cache_key) if cache_key else None
+    metrics.annotate(tier=tier, image=image, cache='hit' if cached is not None else 'miss')
+    degraded = []
+    if cached is not None:
+        result = Result.model_validate_json(cached)
+    else:
+        # Admission: the decoded window's length and rate give the job's cost. Under load the
+        # request gives up the plot, then most of its window, then the full tier, whatever it
+        # takes to finish within ADMISSION_TARGET; if nothing does, 503
+        plan = admit(decoded_header(audio), pool.backlog, pool.scale, tier=tier, image=image, tiers=models.tiers)
+        if plan is None:
+            admissions['shed'] += 1
+            metrics.annotate(shed=True)
+            raise server_busy()
+        job = pool.reserve(plan.cost)
+        try:
+            result = await analyze_upload(file, audio, key, models, plan, job)
+        finally:
+            pool.discard(job)
+        # degraded results go into neither the vector store nor the cache
+        degraded = plan.degraded
+        if not degraded and cache_key and result is not None:
+            await run_in_threadpool(cache.put, cache_key, result.model_dump_json())
 
     if result is None:
         raise HTTPException(status_code=400, detail="Unable to detect mood from audio")
+    metrics.annotate(emotion=result.emotion1.name)
+
+    if result.imageUrl is not None:
+        result.imageUrl = str(request.base_url).rstrip('/') + result.imageUrl
+    result.degraded = degraded or None
+    return result
+
+# runs an admitted /analyze miss as the Plan says; the vector store only keeps full-tier,
+# full-window moods from the default version
+async def analyze_upload(file, audio, key, models, plan, job):
+    model = (models.version, models.fingerprint)
+    song = song_id(key) if (vectors is not None and key and plan.tier == 'full' and plan.window == 45
+                            and models.version == registry.default) else None
+    if plan.degraded:
+        admissions['degraded'] += 1
+        metrics.annotate(degraded=','.join(plan.degraded))
+    if 'window' in plan.degraded:
+        y, file_sr = audio
+        audio = (y[:int(plan.window * file_sr)], file_sr)
+    if song is None:
+        return await run_in_pool(partial(main, model=model), audio, plan.image, plan.tier, job=job)
 
+    result, vector = await run_in_pool(
+        partial(main, with_vector=True, model=model), audio, plan.image, plan.tier, job=job
+    )
+    if result is not None:
+        await run_in_threadpool(vectors.add, [(song, *vector, file.filename)])
+        result.id = song
     return result
+
+# valence/arousal over overlapping windows of the whole track instead of its first 45 s
+@app.post("/analyze/timeline", response_model=TimelineResult, response_model_exclude_none=True)
+async def analyze_timeline(
+    file: UploadFile = File(...),
+    window: float = Query(TIMELINE_WINDOW, ge=5, le=TIMELINE_MAX_SECONDS),
+    hop: float = Query(TIMELINE_HOP, ge=1, le=TIMELINE_MAX_SECONDS),
+    image: Literal['inline', 'none'] = Query('inline'),
+    tier: Literal['full', 'fast'] = Query('full'),
+    model: str | None = Query(None, description="model version, default: by the A/B split")
+):
+    check_upload_size(file)
+    if model is not None:
+        await pick_model(model)
+
+    audio = await decode_upload(file, TIMELINE_MAX_SECONDS)
+    if audio is None:
+        raise HTTPException(status_code=400, detail="Unable to detect mood from audio")
+
+    key = await run_in_threadpool(audio_key, audio, TIMELINE_MAX_SECONDS)
+    models = await pick_model(model, key)
+    require_tier(models, tier)
+    key = f"{key}:timeline:{tier}:{window}:{hop}:{image}:{models.label}" if key else None
+    cached = await run_in_threadpool(cache.get, key) if key else None
+    metrics.annotate(tier=tier, image=image, cache='hit' if cached is not None else 'miss')
+    if cached is not None:
+        return TimelineResult.model_validate_json(cached)
+
+    # the time limit grows with the track, a 45 s clip gets the usual one
+    y, file_sr = audio
+    timeout = pool.timeout * max(1.0, len(y) / file_sr / TIMELINE_WINDOW)
+    cost = job_cost(decoded_header(audio), TIMELINE_MAX_SECONDS, tier, image)
+    result = await run_in_pool(
+        partial(timeline, window=window, hop=hop, image=image, tier=tier, model=(models.version, models.fingerprint)),
+        audio, cost=cost, timeout=timeout
+    )
+    if result is None:
+        raise HTTPException(status_code=400, detail="Unable to detect mood from audio")
+
+    if key:
+        await run_in_threadpool(cache.put, key, result.model_dump_json())
+    return result
+
+# the latest features of a stream scored like an /analyze result, or marked silent
+def stream_update(stream, models):
+    update = {"time": round(stream.seconds, 3)}
+    features = stream.features()
+    if stream.take_silent() or features is None:
+        return {**update, "silent": True}
+    mood = get_moods(features, STREAM_TIER, models)[0]
+    emotions = {name: emotion.model_dump() for name, emotion in top_emotions(mood).items()}
+    return {**update, "valence": float(mood.valence), "arousal": float(mood.arousal), **emotions,
+            "modelVersion": models.label}
+
+# Live analysis: the client sends audio as binary messages while it plays (raw PCM at ?sr=
+# with ?channels= and ?encoding=f32|s16, or with ?format=encoded one complete small file per
+# message) and gets an update every ?interval= seconds of audio, from running statistics of
+# the fast-tier frame features. A text message "end" asks for a final update and closes.
+# Received chunks wait in a small queue; when it's full the server stops reading, so TCP
+# slows a client that sends faster than it can be analyzed. Updates the client doesn't read
+# in time are replaced by newer ones, and a client that stops reading is dropped. The model
+# version (?model=, or drawn by the A/B split) is picked once and kept for the connection
+@app.websocket("/analyze/stream")
+async def analyze_stream(
+    websocket: WebSocket,
+    format: Literal['pcm', 'encoded'] = Query('pcm'),
+    sr: int = Query(22050, ge=1000, le=384000),
+    channels: int = Query(1, ge=1, le=8),
+    encoding: Literal['f32', 's16'] = Query('f32'),
+    interval: float = Query(STREAM_INTERVAL, ge=1, le=60),
+    halflife: float = Query(STREAM_HALFLIFE, ge=0),
+    model: str | None = Query(None)
+):
+    global streams
+    if streams >= STREAM_MAX_CONNECTIONS:
+        await websocket.close(code=1013, reason="Server is busy, try again shortly")
+        return
+    # counted before the first await, so connections arriving meanwhile see this one
+    streams += 1
+    try:
+        try:
+            models = await run_in_threadpool(registry.get, registry.choose(model))
+            models.require(STREAM_TIER)
+        except (ModelVersionError, ModelTierError) as e:
+            await websocket.close(code=1008, reason=str(e)[:120])
+            return
+        await websocket.accept()
+        decoder = PcmDecoder(encoding, channels) if format == 'pcm' else EncodedDecoder()
+        stream = StreamAnalyzer(decoder, halflife=halflife)
+        chunks = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        updates = asyncio.Queue(maxsize=1)
+
+        async def receive():
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                data = message.get("bytes")
+                if data is None:
+                    if message.get("text") == "end":
+                        break
+                    continue
+                if len(data) > STREAM_MAX_CHUNK_BYTES:
+                    raise ValueError(f"Messages are limited to {STREAM_MAX_CHUNK_BYTES // 1024} kB")
+                await chunks.put(data)
+            await chunks.put(None)
+
+        async def analyze():
+            last_update = 0.0
+            while (data := await chunks.get()) is not None:
+                await run_in_threadpool(stream.push, data, sr)
+                if stream.seconds >= last_update + interval:
+                    last_update = stream.seconds
+                    # only the newest update is worth sending, a stale one waiting is replaced
+                    if updates.full():
+                        updates.get_nowait()
+                    updates.put_nowait(await run_in_threadpool(stream_update, stream, models))
+            if stream.seconds > last_update or stream.seconds == 0:
+                await updates.put(await run_in_threadpool(stream_update, stream, models))
+            await updates.put(None)
+
+        async def send():
+            while (update := await updates.get()) is not None:
+                await asyncio.wait_for(websocket.send_json(update), STREAM_SEND_TIMEOUT)
+
+        try:
+            async with asyncio.TaskGroup() as tasks:
+                tasks.create_task(receive())
+                tasks.create_task(analyze())
+                tasks.create_task(send())
+            await websocket.close()
+        except* WebSocketDisconnect:
+            pass
+        except* ValueError as e:
+            await websocket.close(code=1003, reason=str(e.exceptions[0])[:120])
+        except* TimeoutError:
+            await websocket.close(code=1008, reason="Client is not reading updates")
+    finally:
+        streams -= 1
+
+# plot IDs encode the point, so any worker can re-render one and the bytes never change
+@app.get("/plot/{plot_id}")
+async def plot(plot_id: str, request: Request):
+    headers = {
+        "ETag": f'"{plot_id}"',
+        "Cache-Control": f"public, max-age={PLOT_MAX_AGE}",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        content, media_type = await run_in_threadpool(render_plot, plot_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Plot not found")
+    return Response(content=content, media_type=media_type, headers=headers)
+
+def too_many_files():
+    return HTTPException(status_code=400, detail=f"Batches are limited to {MAX_BATCH_FILES} files")
+
+def batch_too_large():
+    return HTTPException(status_code=413, detail=f"Batches are limited to {MAX_BATCH_BYTES // (1024 * 1024)} MB")
+
+# expands any .zip uploads into their member files. Every size is checked before anything is
+# read or decompressed (zipfile never inflates past a member's declared size): each file and
+# member against the upload limit, the batch's running total and each archive's whole
+# expanded size against the batch limit. Expanding stops as soon as the batch has too many files
+async def read_uploads(files):
+    uploads = []
+    total = 0
+    for file in files:
+        check_upload_size(file)
+        if file.size is not None and total + file.size > MAX_BATCH_BYTES:
+            raise batch_too_large()
+        data = await file.read()
+        if not (file.filename or '').lower().endswith('.zip'):
+            if len(uploads) >= MAX_BATCH_FILES:
+                raise too_many_files()
+            total += len(data)
+            if total > MAX_BATCH_BYTES:
+                raise batch_too_large()
+            uploads.append((file.filename, data))
+            continue
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            members = [info for info in archive.infolist()
+                       if not (info.is_dir() or info.filename.startswith('__MACOSX/'))]
+            if len(uploads) + len(members) > MAX_BATCH_FILES:
+                raise too_many_files()
+            if total + sum(info.file_size for info in members) > MAX_BATCH_BYTES:
+                raise batch_too_large()
+            for info in members:
+                if info.file_size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"{info.filename} expands past the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB upload limit"
+                    )
+            for info in members:
+                total += info.file_size
+                uploads.append((info.filename, await run_in_threadpool(archive.read, info)))
+    return uploads
+
+@app.post("/analyze/batch", response_model=BatchResult)
+async def analyze_batch(
+    files: list[UploadFile] = File(...),
+    tier: Literal['full', 'fast'] = Query('full'),
+    model: str | None = Query(None, description="model version, default: by the A/B split")
+):
+    models = await pick_model(model)  # one version scores the whole batch
+    require_tier(models, tier)
+    try:
+        uploads = await read_uploads(files)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Invalid zip archive")
+
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No audio files in request")
+    metrics.annotate(tier=tier, files=len(uploads))
+
+    # one contiguous chunk per worker so extraction runs in parallel and keeps file order
+    bounds = np.linspace(0, len(uploads), min(pool.workers, len(uploads)) + 1).astype(int)
+    chunks = [[data for _, data in uploads[lo:hi]] for lo, hi in zip(bounds[:-1], bounds[1:])]
+    chunk_features = await asyncio.gather(*(
+        run_in_pool(partial(extract_batch, tier=tier), chunk, timeout=pool.timeout * len(chunk))
+        for chunk in chunks
+    ))
+    features, keys = zip(*[item for chunk in chunk_features for item in chunk])
+
+    # scale, predict and rank the whole batch as one matrix
+    extracted = [i for i, f in enumerate(features) if f is not None]
+    moods = await run_in_threadpool(get_moods, np.vstack([features[i] for i in extracted]), tier, models) if extracted else []
+    mood_by_index = dict(zip(extracted, moods))
+
+    results = []
+    stored = []
+    for i, (filename, _) in enumerate(uploads):
+        mood = mood_by_index.get(i)
+        if mood is None:
+            results.append(BatchItem(filename=filename, error="Unable to detect mood from audio"))
+            continue
+        song = song_id(keys[i]) if vectors is not None and tier == 'full' and models.version == registry.default else None
+        if song is not None:
+            stored.append((song, features[i][0], mood.valence, mood.arousal, filename))
+        results.append(BatchItem(
+            filename=filename, id=song, valence=mood.valence, arousal=mood.arousal, **top_emotions(mood)
+        ))
+    if stored:
+        await run_in_threadpool(vectors.add, stored)
+    return BatchResult(modelVersion=models.label, results=results)
+
+def neighbors(query, k, space, exclude=None):
+    scales = load_models()['full'].feature_scales if space == 'features' else None
+    found = vectors.nearest(query, k, space, scales, exclude)
+    described = vectors.describe([row for row, _ in found])
+    results = []
+    for row, distance in found:
+        _, (valence, arousal) = vectors.vector(row)
+        song, name = described[row]
+        results.append(Neighbor(id=song, name=name, distance=distance, valence=valence, arousal=arousal))
+    return SimilarResult(space=space, neighbors=results)
+
+def require_vectors():
+    if vectors is None:
+        raise HTTPException(status_code=404, detail="The vector store is off, set VECTOR_STORE_DIR to enable it")
+
+# the k stored songs closest to a stored one, in scaled full-tier feature space (timbre,
+# rhythm, tonality...) or in valence/arousal space
+@app.get("/similar/{song}", response_model=SimilarResult, response_model_exclude_none=True)
+async def similar_to_song(
+    song: str,
+    k: int = Query(10, ge=1, le=1000),
+    space: Literal['features', 'mood'] = Query('features')
+):
+    require_vectors()
+    row = await run_in_threadpool(vectors.row, song)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Song not found")
+    features, mood = await run_in_threadpool(vectors.vector, row)
+    query = features if space == 'features' else mood
+    return await run_in_threadpool(neighbors, query, k, space, row)
+
+# the k stored songs closest to a feature vector or a valence/arousal point
+@app.post("/similar", response_model=SimilarResult, response_model_exclude_none=True)
+async def similar(query: SimilarQuery):
+    require_vectors()
+    if query.features is not None and (query.valence is not None or query.arousal is not None):
+        raise HTTPException(status_code=422, detail="Give either features or valence and arousal, not both")
+    if query.features is not None:
+        if len(query.features) != vectors.dims:
+            raise HTTPException(status_code=422, detail=f"features must have {vectors.dims} values")
+        return await run_in_threadpool(neighbors, query.features, query.k, 'features')
+    if query.valence is None or query.arousal is None:
+        raise HTTPException(status_code=422, detail="Give features, or both valence and arousal")
+    return await run_in_threadpool(neighbors, (query.valence, query.arousal), query.k, 'mood')
+
+def require_admin(request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints are off, set ADMIN_TOKEN to enable them")
+    if not hmac.compare_digest(request.headers.get('authorization', ''), f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def describe_models(errors=None):
+    loaded = registry.loaded()
+    return {
+        "default": registry.default,
+        "split": registry.split,
+        "versions": [
+            {
+                "version": version,
+                "loaded": loaded[version].label if version in loaded else None,
+                "loadedAt": loaded[version].loaded_at if version in loaded else None,
+                "tiers": sorted(loaded[version].tiers) if version in loaded else None,
+                "error": (errors or {}).get(version),
+            }
+            for version in sorted(set(registry.versions()) | set(loaded))
+        ],
+    }
+
+# model versions on disk and the ones this process has loaded. Pool workers load the
+# version and files the server picked for each job, so they follow the server's swaps
+@app.get("/admin/models")
+async def admin_models(request: Request):
+    require_admin(request)
+    return await run_in_threadpool(describe_models)
+
+# swaps in every loaded version whose files changed, without waiting for the watcher;
+# requests already running finish with the models they started with
+@app.post("/admin/models/reload")
+async def admin_reload_models(request: Request):
+    require_admin(request)
+    errors = await run_in_threadpool(registry.reload)
+    return await run_in_threadpool(describe_models, errors)
+
+# sets the A/B weights of requests that don't ask for a version
+@app.put("/admin/models/split")
+async def admin_model_split(request: Request, split: ModelSplit):
+    require_admin(request)
+    try:
+        for version in split.weights:  # loaded first, so a broken version never gets traffic
+            await run_in_threadpool(registry.get, registry.choose(version))
+        registry.set_split(split.weights)
+    except (ModelVersionError, FeatureSchemaError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return await run_in_threadpool(describe_models)
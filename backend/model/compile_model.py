@@ -0,0 +1,76 @@
+# Compiles the valence and arousal models of each feature tier into one flat tree table for fast serving
+import os
+import sys
+import time
+import joblib
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.compiledtrees import CompiledEnsemble, TreeTooDeep, save_compiled
+from services.getfeatures import FEATURE_SCHEMA_VERSION, FEATURE_TIERS, FeatureSchemaError, check_schema
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# same naming as services/getmood.py: full tier unprefixed, e.g. fast_valence_model.joblib otherwise
+def model_path(filename, tier):
+    return os.path.join(MODEL_DIR, filename if tier == 'full' else f'{tier}_{filename}')
+
+
+def compile_tier(tier):
+    valence_path = model_path('valence_model.joblib', tier)
+    arousal_path = model_path('arousal_model.joblib', tier)
+    scaler_path = model_path('scaler.joblib', tier)
+    output_file = model_path('mood_trees.npz', tier)
+
+    start = time.perf_counter()
+    valence_model = joblib.load(valence_path)
+    arousal_model = joblib.load(arousal_path)
+    scaler = joblib.load(scaler_path)
+    joblib_time = time.perf_counter() - start
+
+    try:
+        check_schema(valence_model, os.path.basename(valence_path), tier)
+        check_schema(arousal_model, os.path.basename(arousal_path), tier)
+        check_schema(scaler, os.path.basename(scaler_path), tier)
+    except FeatureSchemaError as e:
+        sys.exit(f"{e}, retrain with model/train_model.py")
+
+    try:
+        save_compiled(
+            output_file,
+            [valence_model, arousal_model],
+            ['valence', 'arousal'],
+            sources=[valence_path, arousal_path, scaler_path],
+            schema_version=FEATURE_SCHEMA_VERSION,
+            scaler=scaler
+        )
+    except TreeTooDeep as e:
+        sys.exit(f"[{tier}] {e}, or serve the joblib models with MOOD_MODEL_BACKEND=sklearn")
+
+    start = time.perf_counter()
+    compiled = CompiledEnsemble.load(output_file)
+    compiled_time = time.perf_counter() - start
+
+    # Check against sklearn on random inputs around the scaled feature range, and the
+    # embedded scaler against StandardScaler on inputs around the raw feature range
+    X = np.random.default_rng(0).normal(scale=2.0, size=(5000, compiled.n_features))
+    expected = np.column_stack([valence_model.predict(X), arousal_model.predict(X)])
+    max_error = np.max(np.abs(compiled.predict(X) - expected))
+    raw = scaler.mean_ + X * scaler.scale_
+    max_error = max(max_error, np.max(np.abs(compiled.scale(raw) - scaler.transform(raw))))
+    print(f"[{tier}] Max abs difference vs sklearn: {max_error:.3e}")
+    print(f"[{tier}] Load time: joblib {joblib_time * 1000:.1f} ms (incl. sklearn import), compiled {compiled_time * 1000:.1f} ms")
+
+    if max_error > 1e-9:
+        os.remove(output_file)
+        sys.exit(f"Compiled {tier} models don't match sklearn, removed output")
+
+    print(f"[{tier}] Saved {output_file}")
+
+
+for tier in FEATURE_TIERS:
+    if os.path.exists(model_path('valence_model.joblib', tier)):
+        compile_tier(tier)
+    else:
+        print(f"[{tier}] No trained models, skipped")
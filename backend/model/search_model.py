@@ -0,0 +1,192 @@
+# Hyperparameter search for the mood models: k-fold cross-validation of every estimator,
+# parameter and sample weighting combination, ranked on accuracy and serving latency
+#
+#   python search_model.py                          the whole grid, all cores
+#   python search_model.py --estimator hist --weighting linear quadratic --folds 10
+#
+# Each (candidate, fold) pair fits the valence and arousal models in a worker process. Its
+# result is stored in .cache/search-<dataset>/ as soon as it finishes, so an interrupted
+# search resumes where it stopped and a rerun with a bigger grid only fits the new candidates.
+# The folds cover train_model.py's training songs only, its held-out songs stay unseen.
+#
+# Latency is that of the compiled tree table serving uses (services/compiledtrees.py) for one
+# song, the best of several timed runs. It's measured in this process while workers keep
+# fitting, so compare candidates with each other, not with the numbers of benchmark.py.
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import KFold
+from sklearn.metrics import mean_absolute_error
+import joblib
+
+from train_model import (CACHE_DIR, ESTIMATORS, TARGETS, WEIGHTINGS, file_digest, load_dataset, new_model,
+                         sample_weights, split, tree_count)
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.compiledtrees import CompiledEnsemble, compile_ensembles, input_dtype
+from services.getfeatures import FEATURE_TIERS, tier_feature_names
+
+# parameters tried per estimator, on top of train_model.new_model's defaults. Depth is capped:
+# the compiled table holds 2^depth leaves per tree
+GRID = {
+    'gbm': {'n_estimators': [100, 200, 400], 'max_depth': [3, 5], 'learning_rate': [0.05, 0.1]},
+    'hist': {'max_depth': [3, 5, 7], 'learning_rate': [0.05, 0.1], 'l2_regularization': [0.0, 1.0]},
+}
+FOLDS = 5
+LATENCY_CALLS = 100  # single-song predictions per timed run
+LATENCY_REPEATS = 5
+REPORT_FILE = 'search_report.json'
+
+
+def candidates(estimators, weightings):
+    for estimator in estimators:
+        names = sorted(GRID[estimator])
+        for values in itertools.product(*(GRID[estimator][name] for name in names)):
+            for weighting in weightings:
+                yield {'estimator': estimator, 'params': dict(zip(names, values)), 'weighting': weighting}
+
+
+# stable name of a candidate's fold result, the same across runs and grid changes
+def result_file(cache_dir, candidate, tier, folds, fold):
+    key = json.dumps({**candidate, 'tier': tier, 'folds': folds}, sort_keys=True)
+    return os.path.join(cache_dir, f'{hashlib.sha256(key.encode()).hexdigest()[:16]}-{fold}.json')
+
+
+# runs in a worker: fits both targets on the fold's training songs, returns `key` with the
+# validation MAEs and the models' compiled tables
+def fit_fold(key, candidate, tier, train, validation, dataset):
+    columns = tier_feature_names(tier)
+    X = dataset['scaled'][tier]
+    X_train = pd.DataFrame(X[train], columns=columns)
+    X_validation = pd.DataFrame(X[validation], columns=columns)
+
+    start = time.perf_counter()
+    result = {}
+    models = []
+    for target in TARGETS:
+        model = new_model(candidate['estimator'], candidate['params'])
+        weights = sample_weights(dataset, target, candidate['weighting'])
+        model.fit(X_train, dataset[f'{target}_mean'][train], sample_weight=weights[train])
+        result[f'{target}_mae'] = mean_absolute_error(dataset[f'{target}_mean'][validation], model.predict(X_validation))
+        result[f'{target}_trees'] = tree_count(model)
+        models.append(model)
+    result['fit_seconds'] = time.perf_counter() - start
+    return key, result, compile_ensembles(models), input_dtype(models), X[validation[:1]]
+
+
+# seconds per single-song prediction of the compiled models
+def latency(tables, dtype, song):
+    nodes, leaves, init = tables
+    compiled = CompiledEnsemble(nodes, leaves, init, song.shape[1], TARGETS, input_dtype=dtype)
+    compiled.predict(song)
+    runs = []
+    for _ in range(LATENCY_REPEATS):
+        start = time.perf_counter()
+        for _ in range(LATENCY_CALLS):
+            compiled.predict(song)
+        runs.append((time.perf_counter() - start) / LATENCY_CALLS)
+    return min(runs)
+
+
+# candidates no other candidate beats on both mean MAE and latency
+def pareto_front(rows):
+    front = []
+    best_latency = np.inf
+    for row in sorted(rows, key=lambda row: (row['mae'], row['latency_us'])):
+        if row['latency_us'] < best_latency:
+            front.append(row)
+            best_latency = row['latency_us']
+    return front
+
+
+def summarize(candidate, results):
+    maes = [(r['valence_mae'] + r['arousal_mae']) / 2 for r in results]
+    row = {
+        **candidate,
+        'mae': float(np.mean(maes)),
+        'mae_std': float(np.std(maes)),
+        'latency_us': float(np.median([r['latency_seconds'] for r in results]) * 1e6),
+        'fit_seconds': float(np.sum([r['fit_seconds'] for r in results])),
+    }
+    for target in TARGETS:
+        row[f'{target}_mae'] = float(np.mean([r[f'{target}_mae'] for r in results]))
+        row[f'{target}_trees'] = float(np.mean([r[f'{target}_trees'] for r in results]))
+    return row
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cross-validated search over the mood model settings")
+    parser.add_argument('--estimator', nargs='+', choices=ESTIMATORS, default=list(ESTIMATORS))
+    parser.add_argument('--weighting', nargs='+', choices=list(WEIGHTINGS), default=list(WEIGHTINGS))
+    parser.add_argument('--tier', choices=list(FEATURE_TIERS), default='full')
+    parser.add_argument('--folds', type=int, default=FOLDS)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='folds fitted in parallel')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    dataset = load_dataset()
+    train_idx, _ = split(dataset['song_id'])
+    folds = list(KFold(n_splits=args.folds, shuffle=True, random_state=42).split(train_idx))
+    cache_dir = os.path.join(CACHE_DIR, f'search-{file_digest()}')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    grid = list(candidates(args.estimator, args.weighting))
+    results = {}
+    pending = []
+    for c, candidate in enumerate(grid):
+        for fold in range(args.folds):
+            path = result_file(cache_dir, candidate, args.tier, args.folds, fold)
+            if os.path.exists(path):
+                with open(path) as f:
+                    results[c, fold] = json.load(f)
+            else:
+                pending.append((c, fold, path))
+    print(f"{len(grid)} candidates x {args.folds} folds on {len(train_idx)} songs: "
+          f"{len(results)} fold results cached, {len(pending)} to fit on {args.jobs} processes")
+
+    start = time.perf_counter()
+    fits = joblib.Parallel(n_jobs=args.jobs, return_as='generator_unordered')(
+        joblib.delayed(fit_fold)(
+            (c, fold, path), grid[c], args.tier, train_idx[folds[fold][0]], train_idx[folds[fold][1]], dataset
+        )
+        for c, fold, path in pending
+    )
+    for done, ((c, fold, path), result, tables, dtype, song) in enumerate(fits, 1):
+        result['latency_seconds'] = latency(tables, dtype, song)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.replace(path + '.tmp', path)
+        results[c, fold] = result
+        if done % 10 == 0 or done == len(pending):
+            print(f"  {done}/{len(pending)} folds, {time.perf_counter() - start:.0f} s")
+
+    report = [summarize(candidate, [results[c, fold] for fold in range(args.folds)]) for c, candidate in enumerate(grid)]
+    front = pareto_front(report)
+    for row in report:
+        row['pareto'] = any(row is best for best in front)
+    report.sort(key=lambda row: row['mae'])
+
+    print(f"\n{'':1s} {'estimator':9s} {'weighting':10s} {'MAE':>13s} {'latency':>10s} {'trees':>6s}  params")
+    for row in report:
+        trees = np.mean([row[f'{target}_trees'] for target in TARGETS])
+        print(f"{'*' if row['pareto'] else ' '} {row['estimator']:9s} {row['weighting']:10s} "
+              f"{row['mae']:.3f} ± {row['mae_std']:.3f} {row['latency_us']:7.0f} us {trees:6.0f}  {json.dumps(row['params'])}")
+    with open(REPORT_FILE, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n* on the accuracy/latency Pareto front, report in {REPORT_FILE}. Train one with")
+    for row in front:
+        print(f"  python train_model.py --estimator {row['estimator']} --weighting {row['weighting']} "
+              f"--params '{json.dumps(row['params'])}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,89 +1,323 @@
 # Trains the valence and arousal models from the librosa features
+#
+#   python train_model.py                        fresh GradientBoostingRegressors, as served so far
+#   python train_model.py --estimator hist       HistGradientBoostingRegressors with early stopping
+#   python train_model.py --warm-start           adds trees to the saved models for newly annotated songs
+#
+# Every (tier, target) model is fitted in its own process (--jobs). The merged feature and
+# annotation table and its scaled columns are cached in .cache/, keyed by the input files'
+# contents, so reruns skip the CSV parsing and merging.
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
 import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
-from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import mean_absolute_error
 import joblib
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.compiledtrees import MAX_DEPTH
+from services.getfeatures import (FEATURE_NAMES, FEATURE_SCHEMA_VERSION, FEATURE_DTYPE, FEATURE_TIERS,
+                                  extract_features, load_audio, tier_feature_names)
+
 ANNOTATIONS_1 = '../dataset/DEAM_Annotations/annotations/static_annotations_averaged_songs_1_2000.csv'
 ANNOTATIONS_2 = '../dataset/DEAM_Annotations/annotations/static_annotations_averaged_songs_2000_2058.csv'
 FEATURES = '../dataset/audio_features/audio_features.csv'
+FEATURES_SCHEMA = '../dataset/audio_features/audio_features.schema.json'  # written by scripts/getdata.py
+AUDIO_DIR = '../dataset/DEAM_audio/MEMD_audio'  # held-out songs are timed per tier when present
+LATENCY_SONGS = 10
+REPORT_FILE = 'tier_report.json'
+CACHE_DIR = '.cache'
+MANIFEST_FILE = 'training_manifest.json'  # the estimator, weighting and train/test songs of the saved models
+TARGETS = ('valence', 'arousal')
+ESTIMATORS = ('gbm', 'hist')
+HIST_MAX_ITER = 1000  # upper bound, early stopping usually ends far sooner
+WARM_START_TREES = 50  # trees added per model by --warm-start
+
+
+def model_file(filename, tier):
+    return filename if tier == 'full' else f'{tier}_{filename}'
+
+
+def file_digest(paths=(ANNOTATIONS_1, ANNOTATIONS_2, FEATURES)):
+    digest = hashlib.sha256(str(FEATURE_SCHEMA_VERSION).encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+# the merged table as arrays: song IDs, raw features in schema order, target means and
+# stds, and each tier's columns scaled by a StandardScaler fitted on every song
+def build_dataset():
+    annotations1 = pd.read_csv(ANNOTATIONS_1)
+    annotations2 = pd.read_csv(ANNOTATIONS_2)
+
+    annotations = pd.concat([annotations1, annotations2], ignore_index=True)
+    annotations.columns = annotations.columns.str.strip()
+
+    features = pd.read_csv(FEATURES)
+
+    # the table has to come from the same extractor version the models will be served with
+    if os.path.exists(FEATURES_SCHEMA):
+        with open(FEATURES_SCHEMA) as f:
+            table_version = json.load(f)['version']
+        if table_version != FEATURE_SCHEMA_VERSION:
+            sys.exit(f"{FEATURES} is feature schema v{table_version}, the extractor is v{FEATURE_SCHEMA_VERSION}. Rerun scripts/getdata.py")
+    missing = [name for name in FEATURE_NAMES if name not in features.columns]
+    if missing:
+        sys.exit(f"{FEATURES} is missing feature columns: {', '.join(missing)}")
+
+    # merge both
+    data = features.merge(annotations, on='song_id')
+
+    dataset = {
+        'song_id': data['song_id'].to_numpy(),
+        'X': data[FEATURE_NAMES].to_numpy(dtype=FEATURE_DTYPE),
+        'scalers': {},
+        'scaled': {},
+    }
+    for target in TARGETS:
+        dataset[f'{target}_mean'] = data[f'{target}_mean'].to_numpy(dtype=np.float64)
+        dataset[f'{target}_std'] = data[f'{target}_std'].to_numpy(dtype=np.float64)
+    for tier in FEATURE_TIERS:
+        # Standardize features for better model performance
+        scaler = StandardScaler()
+        dataset['scaled'][tier] = scaler.fit_transform(data[tier_feature_names(tier)].astype(FEATURE_DTYPE))
+        dataset['scalers'][tier] = scaler
+    return dataset
+
+
+# build_dataset's result from .cache/ when the CSVs haven't changed since it was stored
+def load_dataset():
+    cache_file = os.path.join(CACHE_DIR, f'dataset-{file_digest()}.joblib')
+    if os.path.exists(cache_file):
+        print(f"Using cached dataset {cache_file}")
+        return joblib.load(cache_file, mmap_mode='r')
+
+    dataset = build_dataset()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    joblib.dump(dataset, cache_file + '.tmp')
+    os.replace(cache_file + '.tmp', cache_file)
+    return dataset
+
+
+# weights for training - emphasize extreme values to reduce center bias. Each weighting
+# maps (annotator agreement weight, 0-1 extremity) to a sample weight
+WEIGHTINGS = {
+    'linear': lambda agreement, extremity: agreement * (1 + extremity),
+    'quadratic': lambda agreement, extremity: agreement * (1 + 2 * extremity ** 2),
+    'agreement': lambda agreement, extremity: agreement,
+    'none': lambda agreement, extremity: np.ones_like(agreement),
+}
+
+
+def sample_weights(dataset, target, weighting='linear'):
+    y = dataset[f'{target}_mean']
+    agreement = 1 / (dataset[f'{target}_std'] + 0.1)
+    # Add extra weight to extreme values (away from center ~5)
+    extremity = np.abs(y - 5) / 4  # 0-1 scale of how extreme
+    return WEIGHTINGS[weighting](agreement, extremity)
+
+
+# 80/20 test / train split, the same songs for every tier. A warm start keeps every song on
+# the side it was on and splits only the new ones
+def split(song_ids, manifest=None):
+    if manifest is None:
+        return train_test_split(np.arange(len(song_ids)), test_size=0.2, random_state=42)
+
+    train_songs, test_songs = set(manifest['train']), set(manifest['test'])
+    new = np.array([i for i, song in enumerate(song_ids) if song not in train_songs and song not in test_songs], dtype=int)
+    new_train, new_test = train_test_split(new, test_size=0.2, random_state=42) if len(new) >= 5 else (new, new[:0])
+    train = np.array([i for i, song in enumerate(song_ids) if song in train_songs], dtype=int)
+    test = np.array([i for i, song in enumerate(song_ids) if song in test_songs], dtype=int)
+    return np.sort(np.concatenate([train, new_train])), np.sort(np.concatenate([test, new_test]))
+
+
+# `params` override the defaults below, e.g. a configuration picked by search_model.py
+def new_model(estimator, params=None):
+    if estimator == 'hist':
+        # histogram-binned boosting fits in a fraction of the time and stops once 10% of the
+        # training songs held out internally stop improving
+        model = HistGradientBoostingRegressor(
+            max_iter=HIST_MAX_ITER,
+            max_depth=5,
+            learning_rate=0.1,
+            early_stopping=True,
+            validation_fraction=0.1,
+            n_iter_no_change=20,
+            random_state=42
+        )
+    else:
+        # Gradient Boosting (less center bias than RF)
+        model = GradientBoostingRegressor(
+            n_estimators=200,
+            max_depth=5,
+            learning_rate=0.1,
+            subsample=0.8,
+            random_state=42
+        )
+    return model.set_params(**(params or {}))
+
+
+# the saved model, set to add `trees` more trees (or boosting iterations) on its next fit
+def warm_model(path, trees):
+    model = joblib.load(path)
+    model.set_params(warm_start=True)
+    if isinstance(model, HistGradientBoostingRegressor):
+        model.set_params(max_iter=model.n_iter_ + trees, early_stopping=False)
+    else:
+        model.set_params(n_estimators=model.n_estimators + trees)
+    return model
+
+
+# runs in a worker process, returns the fitted model and the seconds it took
+def fit(model, X, y, weights):
+    start = time.perf_counter()
+    model.fit(X, y, sample_weight=weights)
+    return model, time.perf_counter() - start
+
+
+def tree_count(model):
+    return model.n_iter_ if isinstance(model, HistGradientBoostingRegressor) else len(model.estimators_)
+
+
+# mean extraction time per tier over the first held-out songs, from decoded audio
+def extraction_latency(tier, song_ids):
+    paths = [os.path.join(AUDIO_DIR, f'{song_id}.mp3') for song_id in song_ids]
+    clips = [load_audio(path) for path in paths[:LATENCY_SONGS] if os.path.exists(path)]
+    if not clips:
+        return None
+    extract_features(clips[0], tier=tier)  # warm numba caches before timing
+    start = time.perf_counter()
+    for y in clips:
+        extract_features(y, tier=tier)
+    return (time.perf_counter() - start) / len(clips)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the valence and arousal models of every feature tier")
+    parser.add_argument('--estimator', choices=ESTIMATORS, default='gbm')
+    parser.add_argument('--params', type=json.loads, default={},
+                        help='estimator parameters as JSON, e.g. \'{"max_depth": 4, "learning_rate": 0.05}\'')
+    parser.add_argument('--weighting', choices=list(WEIGHTINGS), default='linear', help='sample weighting formula')
+    parser.add_argument('--jobs', type=int, default=min(2 * len(FEATURE_TIERS), os.cpu_count() or 1),
+                        help='models fitted in parallel')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='continue the saved models on the current data, keeping their scalers and split')
+    parser.add_argument('--trees', type=int, default=WARM_START_TREES, help='trees added per model by --warm-start')
+    parser.add_argument('--no-cache', action='store_true', help='rebuild the merged dataset even if it is cached')
+    args = parser.parse_args()
+    # serving compiles the trees into tables padded to 2^depth leaves per tree
+    depth = args.params.get('max_depth', 5)
+    if not isinstance(depth, int) or depth > MAX_DEPTH:
+        parser.error(f"max_depth must be at most {MAX_DEPTH} for compile_model.py to compile the models, got {depth}")
+    return args
+
+
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    dataset = build_dataset() if args.no_cache else load_dataset()
+    song_ids = dataset['song_id']
+    print(f"Matched {len(song_ids)} songs with annotations ({time.perf_counter() - start:.2f} s)")
+
+    manifest = None
+    if args.warm_start:
+        if not os.path.exists(MANIFEST_FILE):
+            sys.exit(f"No {MANIFEST_FILE}, train from scratch first")
+        with open(MANIFEST_FILE) as f:
+            manifest = json.load(f)
+        if manifest['feature_schema_version'] != FEATURE_SCHEMA_VERSION:
+            sys.exit("The saved models are for another feature schema, train from scratch")
+        args.estimator = manifest['estimator']
+        args.weighting = manifest.get('weighting', 'linear')
+    train_idx, test_idx = split(song_ids, manifest)
+    if manifest is not None:
+        print(f"Warm start: {len(train_idx) - len(manifest['train'])} new training songs, "
+              f"{len(test_idx) - len(manifest['test'])} new test songs, +{args.trees} trees per model")
+
+    # A warm start keeps the saved scalers: the saved trees split on values scaled by them
+    scalers, scaled = {}, {}
+    for tier in FEATURE_TIERS:
+        if manifest is not None:
+            scalers[tier] = joblib.load(model_file('scaler.joblib', tier))
+            X = pd.DataFrame(dataset['X'], columns=FEATURE_NAMES)[tier_feature_names(tier)]
+            scaled[tier] = scalers[tier].transform(X)
+        else:
+            scalers[tier], scaled[tier] = dataset['scalers'][tier], dataset['scaled'][tier]
+
+    jobs = [(tier, target) for tier in FEATURE_TIERS for target in TARGETS]
+    models = [
+        warm_model(model_file(f'{target}_model.joblib', tier), args.trees) if manifest is not None else new_model(args.estimator, args.params)
+        for tier, target in jobs
+    ]
+    print(f"Training {len(jobs)} {args.estimator} models on {args.jobs} processes...")
+    start = time.perf_counter()
+    fitted = joblib.Parallel(n_jobs=args.jobs)(
+        joblib.delayed(fit)(
+            model,
+            pd.DataFrame(scaled[tier][train_idx], columns=tier_feature_names(tier)),
+            dataset[f'{target}_mean'][train_idx],
+            sample_weights(dataset, target, args.weighting)[train_idx]
+        )
+        for model, (tier, target) in zip(models, jobs)
+    )
+    print(f"Trained in {time.perf_counter() - start:.1f} s: " +
+          ", ".join(f"{tier} {target} {seconds:.1f} s / {tree_count(model)} trees"
+                    for (tier, target), (model, seconds) in zip(jobs, fitted)))
+    fitted = {job: model for job, (model, _) in zip(jobs, fitted)}
+
+    #
+    # Accuracy vs latency report on the held-out split
+    #
+    report = []
+    for tier in FEATURE_TIERS:
+        X_test = pd.DataFrame(scaled[tier][test_idx], columns=tier_feature_names(tier))
+        row = {'tier': tier, 'features': len(tier_feature_names(tier)), 'estimator': args.estimator}
+        for target in TARGETS:
+            # Evaluate + Print Results
+            model = fitted[tier, target]
+            pred = model.predict(X_test)
+            row[f'{target}_mae'] = mean_absolute_error(dataset[f'{target}_mean'][test_idx], pred)
+            row[f'{target}_trees'] = tree_count(model)
+            print(f"[{tier}] {target.capitalize()} MAE: {row[f'{target}_mae']:.3f}, "
+                  f"pred range: [{pred.min():.2f}, {pred.max():.2f}]")
+
+            # Save models, stamped with the schema they were fitted on
+            model.set_params(warm_start=False)
+            model.feature_schema_version_ = FEATURE_SCHEMA_VERSION
+            joblib.dump(model, model_file(f'{target}_model.joblib', tier))
+        scalers[tier].feature_schema_version_ = FEATURE_SCHEMA_VERSION
+        joblib.dump(scalers[tier], model_file('scaler.joblib', tier))
+        row['extract_seconds'] = extraction_latency(tier, song_ids[test_idx])
+        report.append(row)
+
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump({
+            'estimator': args.estimator,
+            'params': args.params if manifest is None else manifest.get('params', {}),
+            'weighting': args.weighting,
+            'feature_schema_version': FEATURE_SCHEMA_VERSION,
+            'train': [int(song) for song in song_ids[train_idx]],
+            'test': [int(song) for song in song_ids[test_idx]],
+        }, f)
+
+    print(f"\n{'tier':8s} {'features':>8s} {'valence MAE':>12s} {'arousal MAE':>12s} {'extract':>10s}")
+    for row in report:
+        latency = f"{row['extract_seconds'] * 1000:.0f} ms" if row['extract_seconds'] is not None else 'no audio'
+        print(f"{row['tier']:8s} {row['features']:8d} {row['valence_mae']:12.3f} {row['arousal_mae']:12.3f} {latency:>10s}")
+    with open(REPORT_FILE, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nAll Done, report in {REPORT_FILE}. Run compile_model.py to refresh the tree tables")
+
 
-annotations1 = pd.read_csv(ANNOTATIONS_1)
-annotations2 = pd.read_csv(ANNOTATIONS_2)
-
-annotations = pd.concat([annotations1, annotations2], ignore_index=True)
-annotations.columns = annotations.columns.str.strip()
-
-features = pd.read_csv(FEATURES)
-
-# merge both
-data = features.merge(annotations, on='song_id')
-print(f"Matched {len(data)} songs with annotations")
-
-# Prepare features and targets
-audio_feature_cols = [col for col in features.columns if col != 'song_id']
-feature_cols = audio_feature_cols
-
-X = data[feature_cols]
-y_valence = data['valence_mean']
-y_arousal = data['arousal_mean']
-
-# Standardize features for better model performance
-scaler = StandardScaler()
-X_scaled = pd.DataFrame(scaler.fit_transform(X), columns=X.columns)
-
-# weights for training - emphasize extreme values to reduce center bias
-valence_weights = 1 / (data['valence_std'] + 0.1)
-arousal_weights = 1 / (data['arousal_std'] + 0.1)
-
-# Add extra weight to extreme values (away from center ~5)
-valence_extremity = np.abs(y_valence - 5) / 4  # 0-1 scale of how extreme
-arousal_extremity = np.abs(y_arousal - 5) / 4
-valence_weights = valence_weights * (1 + valence_extremity)
-arousal_weights = arousal_weights * (1 + arousal_extremity)
-
-# Split up data to 80/20 Test / Train Split
-X_train, X_test, y_val_train, y_val_test, y_aro_train, y_aro_test, val_weights_train, _, aro_weights_train, _ = train_test_split(
-    X_scaled, y_valence, y_arousal, valence_weights, arousal_weights, test_size=0.2, random_state=42
-)
-
-# Train valence model with Gradient Boosting (less center bias than RF)
-print("Training valence model...")
-valence_model = GradientBoostingRegressor(
-    n_estimators=200,
-    max_depth=5,
-    learning_rate=0.1,
-    subsample=0.8,
-    random_state=42
-)
-valence_model.fit(X_train, y_val_train, sample_weight=val_weights_train)
-
-# Train arousal model
-print("Training arousal model...")
-arousal_model = GradientBoostingRegressor(
-    n_estimators=200,
-    max_depth=5,
-    learning_rate=0.1,
-    subsample=0.8,
-    random_state=42
-)
-arousal_model.fit(X_train, y_aro_train, sample_weight=aro_weights_train)
-
-# Evaluate + Print Results
-val_pred = valence_model.predict(X_test)
-aro_pred = arousal_model.predict(X_test)
-print(f"\nValence MAE: {mean_absolute_error(y_val_test, val_pred):.3f}")
-print(f"Arousal MAE: {mean_absolute_error(y_aro_test, aro_pred):.3f}")
-
-# Check prediction spread
-print(f"\nValence pred range: [{val_pred.min():.2f}, {val_pred.max():.2f}]")
-print(f"Arousal pred range: [{aro_pred.min():.2f}, {aro_pred.max():.2f}]")
-
-# Save models and scaler
-joblib.dump(valence_model, 'valence_model.joblib')
-joblib.dump(arousal_model, 'arousal_model.joblib')
-joblib.dump(scaler, 'scaler.joblib')
-print("\nAll Done")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
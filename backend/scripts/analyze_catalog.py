@@ -0,0 +1,231 @@
+"""Bulk catalog analyzer: the production pipeline over a directory of audio, offline.
+
+Scans directories (recursively) and/or file lists for audio, runs get_features and the
+mood models over a process pool and writes one row per track: path, valence, arousal
+and the top 3 emotions with their percentages, plus the raw feature vector with
+--features. Rows are written in batches as they finish, so memory stays flat however
+large the catalog is:
+
+  CSV      one file, each batch appended and flushed
+  Parquet  a directory with one part-NNNNN.parquet file per batch (needs pyarrow);
+           every part is written under a temporary name and renamed, so a killed run
+           never leaves a half-written one
+
+Paths already in the output are skipped, so an interrupted or nightly run picks up where
+the last one stopped. Files that fail are listed in <output>.failed.tsv with the reason
+and tried again next time. With --store the full-tier vectors also go into a vector store
+(services/vectorstore.py), under the same song IDs the API gives, for /similar.
+
+    python scripts/analyze_catalog.py /music --output catalog.parquet --features
+    python scripts/analyze_catalog.py --list new_tracks.txt --output catalog.csv --tier fast
+    python scripts/analyze_catalog.py /music --output catalog.csv --store /data/vectors
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).parent.parent))
+from services.cache import audio_key
+from services.getfeatures import (
+    FEATURE_SCHEMA_VERSION, FEATURE_TIERS, decode_audio, decode_rate, tier_feature_names, try_features
+)
+from services.getmood import get_moods, load_models
+from services.vectorstore import VectorStore, song_id
+
+AUDIO_EXTENSIONS = {'.wav', '.flac', '.ogg', '.oga', '.opus', '.mp3', '.aif', '.aiff'}
+CHUNK_SIZE = 8  # files per worker task
+BATCH_SIZE = 512  # rows per write
+IN_FLIGHT = 4  # tasks queued per worker, bounds memory for huge catalogs
+
+
+def find_audio(inputs, lists):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                paths += [os.path.join(root, name) for name in files if Path(name).suffix.lower() in AUDIO_EXTENSIONS]
+        else:
+            paths.append(item)
+    for file_list in lists:
+        with open(file_list) as f:
+            paths += [line.strip() for line in f if line.strip()]
+    return sorted({os.path.abspath(path) for path in paths})
+
+
+def _init_worker():
+    load_models()
+
+
+# runs in a worker: extracts a chunk of files, then scores them as one matrix. Returns
+# (rows, failures, vectors), rows as dicts in the output's column order and, with
+# with_vectors, (song ID, features, valence, arousal, path) for the vector store
+def analyze_chunk(paths, tier, with_features, with_vectors=False):
+    extracted = []
+    failures = []
+    for path in paths:
+        try:
+            audio = decode_audio(path, 45, decode_rate())  # decoded once for the features and the ID
+        except Exception as e:
+            failures.append((path, f"{type(e).__name__}: {e}"))
+            continue
+        features, reason = try_features(audio, tier=tier)
+        if features is None:
+            failures.append((path, reason))
+        else:
+            extracted.append((path, features, audio_key(audio) if with_vectors else None))
+    moods = get_moods(np.vstack([f for _, f, _ in extracted]), tier) if extracted else []
+
+    names = tier_feature_names(tier)
+    rows = []
+    vectors = []
+    for (path, features, key), mood in zip(extracted, moods):
+        row = {
+            'path': path,
+            'valence': mood.valence,
+            'arousal': mood.arousal,
+            'emotion1': mood.emotion1, 'percentage1': mood.percentage1,
+            'emotion2': mood.emotion2, 'percentage2': mood.percentage2,
+            'emotion3': mood.emotion3, 'percentage3': mood.percentage3,
+            'tier': tier,
+        }
+        if with_features:
+            row['feature_schema_version'] = FEATURE_SCHEMA_VERSION
+            row.update(zip(names, features[0]))
+        rows.append(row)
+        if key is not None:
+            vectors.append((song_id(key), features[0], mood.valence, mood.arousal, path))
+    return rows, failures, vectors
+
+
+class CsvOutput:
+    def __init__(self, path):
+        self.path = path
+
+    def done_paths(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return set()
+        # a run killed mid-write can leave a partial last line, which is skipped
+        return set(pd.read_csv(self.path, usecols=['path'], on_bad_lines='skip')['path'])
+
+    def write(self, rows):
+        header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a') as f:
+            f.write(pd.DataFrame(rows).to_csv(index=False, header=header))
+            f.flush()
+
+
+class ParquetOutput:
+    def __init__(self, path):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            sys.exit("Parquet output needs pyarrow (pip install pyarrow), or write a .csv instead")
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.parts = len(self._part_files())
+
+    def _part_files(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+
+    def done_paths(self):
+        return {path for part in self._part_files() for path in pd.read_parquet(part, columns=['path'])['path']}
+
+    def write(self, rows):
+        base = os.path.join(self.path, f'part-{self.parts:05d}')
+        pd.DataFrame(rows).to_parquet(f'{base}.tmp', index=False)
+        os.replace(f'{base}.tmp', f'{base}.parquet')
+        self.parts += 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*', help='audio files or directories, scanned recursively')
+    parser.add_argument('--list', action='append', default=[], help='text file with one audio path per line')
+    parser.add_argument('--output', required=True, help='.csv file or .parquet directory')
+    parser.add_argument('--format', choices=['csv', 'parquet'], help='default: from the output extension')
+    parser.add_argument('--tier', default='full', choices=list(FEATURE_TIERS))
+    parser.add_argument('--features', action='store_true', help='also write the raw feature vector')
+    parser.add_argument('--store', help='also add the vectors to the vector store in this directory (full tier only)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='files per worker task')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows per write')
+    args = parser.parse_args()
+    if not args.inputs and not args.list:
+        parser.error('give audio files, directories or --list')
+    if args.store and args.tier != 'full':
+        parser.error('the vector store only holds full-tier vectors')
+    if args.format is None:
+        args.format = 'parquet' if args.output.endswith('.parquet') else 'csv'
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.tier not in load_models():
+        sys.exit(f"The default model version has no {args.tier} tier models, train them with model/train_model.py")
+    output = ParquetOutput(args.output) if args.format == 'parquet' else CsvOutput(args.output)
+    store = VectorStore(args.store) if args.store else None
+    failures_file = f"{args.output.rstrip(os.sep)}.failed.tsv"
+
+    paths = find_audio(args.inputs, args.list)
+    done = output.done_paths()
+    remaining = [path for path in paths if path not in done]
+    print(f"Found {len(paths)} audio files, {len(paths) - len(remaining)} already in {args.output}, "
+          f"{len(remaining)} to analyze on {args.workers} workers")
+    if not remaining:
+        return
+
+    chunks = iter([remaining[i:i + args.chunk_size] for i in range(0, len(remaining), args.chunk_size)])
+    pending_rows = []
+    succeeded = failed = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as executor, \
+            open(failures_file, 'a') as failures, \
+            tqdm(total=len(remaining), desc="Analyzing", unit='track') as progress:
+        # only a few tasks per worker are queued at a time, the rest are submitted as these finish
+        running = set()
+        while True:
+            for chunk in chunks:
+                running.add(executor.submit(analyze_chunk, chunk, args.tier, args.features, store is not None))
+                if len(running) >= args.workers * IN_FLIGHT:
+                    break
+            if not running:
+                break
+
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                rows, failed_files, vectors = future.result()
+                pending_rows += rows
+                if vectors:
+                    store.add(vectors)
+                for path, reason in failed_files:
+                    failures.write(f"{path}\t{reason}\n")
+                failures.flush()
+                succeeded += len(rows)
+                failed += len(failed_files)
+                progress.update(len(rows) + len(failed_files))
+
+            if len(pending_rows) >= args.batch_size:
+                output.write(pending_rows)
+                pending_rows = []
+
+        if pending_rows:
+            output.write(pending_rows)
+
+    elapsed = time.perf_counter() - start
+    print(f"\nAnalyzed {succeeded} tracks, {failed} failed (reasons in {failures_file})")
+    print(f"Time elapsed: {elapsed / 60:.1f} minutes, {(succeeded + failed) / elapsed:.2f} tracks/s "
+          f"({(succeeded + failed) / elapsed * 3600:,.0f} tracks/hour on {args.workers} workers)")
+
+
+if __name__ == '__main__':
+    main()
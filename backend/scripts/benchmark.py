@@ -0,0 +1,335 @@
+"""End-to-end benchmark suite for the analysis pipeline.
+
+Synthesizes its own audio (tones, noise and rhythmic clicks at several lengths, sample
+rates, channel counts and formats) so every run measures the same input, then times:
+
+  features/<case>   get_features on the encoded file (decode, resample, extract)
+  mood              get_mood on one feature vector
+  plot/cold, /hit   visualize_emotion with an empty render cache and memoized
+  analyze/<mode>    POST /analyze through an in-process ASGI client, every request with
+                    unique audio so the result cache misses, and once more cached
+  concurrency/<n>   n clients posting unique audio at once: throughput and latency
+
+Under load /analyze may answer degraded (less work) or shed the request with a 503. Those
+are counted per section ('degraded', 'shed') and left out of the latencies, which only
+time full analyses; --no-admission raises ADMISSION_TARGET so every request runs in full.
+
+Reports p50/p90/p99 latency, throughput for the concurrency runs and the peak RSS of
+this process per section (Linux, read from /proc; pool workers are separate processes). --save writes the results as a JSON baseline with
+the commit and library versions; --compare prints the change against a saved baseline.
+
+    python scripts/benchmark.py --save benchmarks/$(git rev-parse --short HEAD).json
+    python scripts/benchmark.py --no-admission --compare benchmarks/f090b6b.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+sys.path.append(str(Path(__file__).parent.parent))
+os.environ.setdefault('REQUEST_LOG', '0')  # the JSON request log would drown the report
+
+SIGNALS = ('tone', 'noise', 'clicks')
+REGRESSION_THRESHOLD = 1.10  # --compare flags a p50 more than 10% slower than the baseline
+
+
+# one case per varied dimension around a 45 s, 44.1 kHz stereo WAV of tone + clicks
+def audio_cases(quick=False):
+    base = {'signal': 'tone+clicks', 'seconds': 45, 'sr': 44100, 'channels': 2, 'format': 'WAV'}
+    cases = [dict(base, signal=signal) for signal in SIGNALS] + [base]
+    cases += [dict(base, seconds=seconds) for seconds in (10, 120)]
+    cases += [dict(base, sr=sr) for sr in (22050, 48000)]
+    cases += [dict(base, channels=1)]
+    cases += [dict(base, format=fmt) for fmt in ('FLAC', 'OGG', 'MP3')]
+    if quick:
+        cases = [dict(base, seconds=10)]
+    return cases
+
+
+def case_name(case):
+    return f"{case['signal']}-{case['seconds']}s-{case['sr'] // 1000}k-{case['channels']}ch-{case['format'].lower()}"
+
+
+def synthesize(signal, seconds, sr, channels, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    parts = {
+        'tone': lambda: 0.4 * np.sin(2 * np.pi * 440 * t) * (1 + 0.3 * np.sin(2 * np.pi * 0.5 * t)),
+        'noise': lambda: 0.2 * rng.standard_normal(len(t)),
+        'clicks': lambda: _clicks(len(t), sr, bpm=120),
+    }
+    y = sum(parts[part]() for part in signal.split('+'))
+    y = y + 0.005 * rng.standard_normal(len(t))  # keeps every seed's PCM, and cache key, distinct
+    # the second channel is slightly delayed so the mono downmix isn't a plain copy
+    stereo = np.stack([y, np.roll(y, 7)], axis=1)[:, :channels]
+    return np.clip(stereo, -1, 1).astype(np.float32)
+
+
+def _clicks(n, sr, bpm):
+    clicks = np.zeros(n)
+    clicks[::int(sr * 60 / bpm)] = 1.0
+    return 0.6 * np.convolve(clicks, np.hanning(128), mode='same')
+
+
+def encode(y, sr, fmt):
+    buf = io.BytesIO()
+    subtype = {'WAV': 'PCM_16', 'FLAC': 'PCM_16'}.get(fmt)
+    sf.write(buf, y, sr, format=fmt, subtype=subtype)
+    return buf.getvalue()
+
+
+def encode_case(case, seed=0):
+    return encode(synthesize(case['signal'], case['seconds'], case['sr'], case['channels'], seed), case['sr'], case['format'])
+
+
+# peak resident memory since the last reset, in MiB (None where /proc isn't available)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mib():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def summarize(samples, **extra):
+    samples = np.asarray(samples)
+    if not len(samples):
+        return {'n': 0, 'mean_ms': None, 'p50_ms': None, 'p90_ms': None, 'p99_ms': None, **extra}
+    return {
+        'n': len(samples),
+        'mean_ms': float(np.mean(samples) * 1000),
+        'p50_ms': float(np.percentile(samples, 50) * 1000),
+        'p90_ms': float(np.percentile(samples, 90) * 1000),
+        'p99_ms': float(np.percentile(samples, 99) * 1000),
+        **extra,
+    }
+
+
+def timed(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def section(results, name, run):
+    reset_peak_rss()
+    result = run()
+    result['peak_rss_mib'] = peak_rss_mib()
+    results[name] = result
+    print_result(results, name)
+
+
+def bench_components(results, args):
+    from services.getfeatures import get_features
+    from services.getmood import get_mood
+    from services import visualization
+
+    for case in audio_cases(args.quick):
+        data = encode_case(case)
+        for tier in args.tiers:
+            section(results, f'features/{tier}/{case_name(case)}',
+                    lambda: summarize(timed(lambda: get_features(data, tier=tier), args.repeats)))
+
+    features = get_features(encode_case(audio_cases(True)[0]))
+    section(results, 'mood', lambda: summarize(timed(lambda: get_mood(features), 200)))
+
+    def plot_cold():
+        samples = []
+        for valence, arousal in np.random.default_rng(0).uniform(0, 1, size=(args.repeats * 5, 2)):
+            visualization._render.cache_clear()
+            start = time.perf_counter()
+            visualization.visualize_emotion(valence, arousal)
+            samples.append(time.perf_counter() - start)
+        return summarize(samples)
+
+    section(results, 'plot/cold', plot_cold)
+    section(results, 'plot/hit', lambda: summarize(timed(lambda: visualization.visualize_emotion(0.5, 0.5), 200)))
+
+
+async def bench_api(results, args):
+    import httpx
+    import main
+
+    case = dict(audio_cases(True)[0], seconds=args.api_seconds)
+    seeds = iter(range(1, 1_000_000))
+
+    # (seconds, 'full' | 'degraded' | 'shed')
+    async def post(client, data, image='inline', tier='full'):
+        start = time.perf_counter()
+        response = await client.post(f'/analyze?image={image}&tier={tier}', files={'file': ('bench.wav', data)})
+        seconds = time.perf_counter() - start
+        if response.status_code == 503:
+            return seconds, 'shed'
+        response.raise_for_status()
+        return seconds, 'degraded' if response.json().get('degraded') else 'full'
+
+    # latencies of the full analyses only, degraded and shed requests are just counted
+    def tally(posted, **extra):
+        samples = [seconds for seconds, outcome in posted if outcome == 'full']
+        counts = {outcome: sum(o == outcome for _, o in posted) for outcome in ('degraded', 'shed')}
+        return summarize(samples, **counts, **extra)
+
+    # /analyze refuses tiers the models weren't trained for
+    tiers = [tier for tier in args.tiers if tier in main.load_models()]
+    for tier in sorted(set(args.tiers) - set(tiers)):
+        print(f"{'analyze/' + tier:44s} skipped, no {tier} tier models")
+    if not tiers:
+        return
+
+    # ASGITransport doesn't run the lifespan, so the pool is started through it here
+    async with main.lifespan(main.app):
+        while not main.pool.ready:
+            await asyncio.sleep(0.1)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            for tier in tiers:
+                for image in ('inline', 'none'):
+                    reset_peak_rss()
+                    posted = [await post(client, encode_case(case, next(seeds)), image, tier) for _ in range(args.repeats)]
+                    results[f'analyze/{tier}/{image}'] = tally(posted, peak_rss_mib=peak_rss_mib())
+                    print_result(results, f'analyze/{tier}/{image}')
+
+            cached = encode_case(case, 0)
+            await post(client, cached)
+            reset_peak_rss()
+            posted = [await post(client, cached) for _ in range(args.repeats * 5)]
+            results['analyze/cached'] = tally(posted, peak_rss_mib=peak_rss_mib())
+            print_result(results, 'analyze/cached')
+
+            # every client posts its own unique clips, so nothing is served from the cache
+            for clients in args.concurrency:
+                uploads = [[encode_case(case, next(seeds)) for _ in range(args.requests_per_client)] for _ in range(clients)]
+
+                async def client_loop(clips):
+                    return [await post(client, clip, 'none', tiers[0]) for clip in clips]
+
+                reset_peak_rss()
+                start = time.perf_counter()
+                latencies = await asyncio.gather(*(client_loop(clips) for clips in uploads))
+                elapsed = time.perf_counter() - start
+                posted = [p for loop in latencies for p in loop]
+                full = sum(outcome == 'full' for _, outcome in posted)
+                results[f'concurrency/{clients}'] = tally(
+                    posted, throughput=full / elapsed, clients=clients, peak_rss_mib=peak_rss_mib()
+                )
+                print_result(results, f'concurrency/{clients}')
+
+
+def print_result(results, name):
+    result = results[name]
+    if result['p50_ms'] is None:
+        line = f"{name:44s} no full analyses"
+    else:
+        line = f"{name:44s} p50 {result['p50_ms']:9.1f} ms  p90 {result['p90_ms']:9.1f} ms  p99 {result['p99_ms']:9.1f} ms"
+    if result.get('peak_rss_mib') is not None:
+        line += f"  rss {result['peak_rss_mib']:6.0f} MiB"
+    if 'throughput' in result:
+        line += f"  {result['throughput']:6.2f} req/s"
+    if result.get('degraded') or result.get('shed'):
+        line += f"  ({result['degraded']} degraded, {result['shed']} shed)"
+    print(line, flush=True)
+
+
+def metadata():
+    import librosa
+    import sklearn
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'librosa': librosa.__version__,
+        'sklearn': sklearn.__version__,
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nvs {baseline_path} (commit {baseline['meta'].get('commit')}), p50 new / old:")
+    regressions = 0
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old is None or old['p50_ms'] is None or result['p50_ms'] is None:
+            continue
+        ratio = result['p50_ms'] / old['p50_ms']
+        flag = '  SLOWER' if ratio > REGRESSION_THRESHOLD else ''
+        regressions += bool(flag)
+        print(f"  {name:44s} {old['p50_ms']:9.1f} -> {result['p50_ms']:9.1f} ms  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='one 10 s clip, fewer repeats')
+    parser.add_argument('--repeats', type=int, default=None, help='timed runs per measurement')
+    parser.add_argument('--tiers', nargs='+', default=['full', 'fast'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8], help='client counts')
+    parser.add_argument('--requests-per-client', type=int, default=3)
+    parser.add_argument('--api-seconds', type=int, default=45, help='length of the clips posted to /analyze')
+    parser.add_argument('--skip-api', action='store_true', help='only the in-process component benchmarks')
+    parser.add_argument('--no-admission', action='store_true',
+                        help='never degrade or shed /analyze requests, to time full analyses under any load')
+    parser.add_argument('--save', help='write the results as a JSON baseline here')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    args = parser.parse_args()
+    if args.repeats is None:
+        args.repeats = 3 if args.quick else 10
+    if args.quick:
+        args.api_seconds = min(args.api_seconds, 10)
+        args.concurrency = args.concurrency[:2]
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.no_admission:
+        os.environ['ADMISSION_TARGET'] = '1e9'  # read when services.admission is imported
+    results = {}
+    bench_components(results, args)
+    if not args.skip_api:
+        asyncio.run(bench_api(results, args))
+
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'meta': metadata(), 'args': vars(args), 'results': results}, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare and compare(results, args.compare):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Benchmark server startup, broken down by phase.
+
+Every measurement runs in a fresh interpreter so import, unpickling and numba JIT costs
+are cold. First starts uvicorn in each STARTUP_MODE and reports the wall time from launch
+until GET / answers and until it reports the workers ready. Then times the individual
+phases in one process: importing main, loading the models with each backend, decoding the
+base graph, importing librosa's submodules and the numba warm-up, followed by one warm
+fast-tier extraction to show what a request pays afterwards. Medians of RUNS runs.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+
+BACKEND = Path(__file__).parent.parent
+RUNS = 3
+WORKERS = 1  # one warm-up at a time keeps the workers from skewing the server's own timings
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def health(port):
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1) as response:
+            return json.load(response)
+    except OSError:
+        return None
+
+
+# wall time from launching uvicorn to the first health answer and to ready: true
+def server_start(mode):
+    port = free_port()
+    env = dict(os.environ, STARTUP_MODE=mode, ANALYSIS_WORKERS=str(WORKERS))
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port)],
+        cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        first = None
+        while True:
+            status = health(port)
+            if status is not None and first is None:
+                first = time.perf_counter() - start
+            if status is not None and status.get('ready'):
+                return first, time.perf_counter() - start
+            if server.poll() is not None:
+                raise RuntimeError(f'uvicorn exited with {server.returncode}')
+            time.sleep(0.02)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# runs in a fresh interpreter (--phases), prints {phase: seconds} as JSON
+def phases():
+    sys.path.insert(0, str(BACKEND))
+    timings = {}
+
+    def timed(name, fn):
+        start = time.perf_counter()
+        result = fn()
+        timings[name] = time.perf_counter() - start
+        return result
+
+    main = timed('import main', lambda: __import__('main'))
+    from services import getfeatures, getmood, visualization
+
+    timed(f'load models ({getmood.MODEL_BACKEND})', main.load_models)
+    timed('decode base graph', visualization.load_base_graph)
+
+    import librosa
+    timed('import librosa kernels', lambda: (
+        librosa.feature.mfcc, librosa.beat.beat_track, librosa.decompose.hpss, librosa.onset.onset_strength
+    ))
+    timed('numba warm-up', getfeatures.warm_up)
+
+    y = np.random.default_rng(0).normal(scale=0.1, size=45 * 22050).astype(np.float32)
+    timed('fast extraction (warm)', lambda: getfeatures.extract_features(y, tier='fast'))
+    print(json.dumps(timings))
+
+
+def run_phases(backend):
+    output = subprocess.run(
+        [sys.executable, __file__, '--phases'],
+        env=dict(os.environ, MOOD_MODEL_BACKEND=backend),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    print(f"{'server start':28s} {'first health':>13s} {'ready':>9s}")
+    for mode in ('eager', 'background', 'lazy'):
+        times = np.array([server_start(mode) for _ in range(RUNS)])
+        first, ready = np.median(times, axis=0)
+        print(f"  STARTUP_MODE={mode:14s} {first * 1000:10.0f} ms {ready * 1000:6.0f} ms")
+
+    print(f"\n{'phase':28s} {'median':>13s}")
+    for backend in ('compiled', 'sklearn'):
+        runs = [run_phases(backend) for _ in range(RUNS)]
+        print(f"  MOOD_MODEL_BACKEND={backend}")
+        for name in runs[0]:
+            print(f"    {name:26s} {np.median([run[name] for run in runs]) * 1000:8.0f} ms")
+
+
+if __name__ == '__main__':
+    if '--phases' in sys.argv:
+        phases()
+    else:
+        main()
@@ -0,0 +1,69 @@
+"""Benchmark the plot renderer against the original full-resolution render.
+
+The original copied the 2379x2379 base, drew on it and LANCZOS-resized it to 800px on
+every call. Prints mean time per call and peak RSS growth for that path, for the
+compositing renderer with an empty cache and for a memoized hit. Pillow allocates pixel
+buffers outside tracemalloc's view, so memory is read from /proc (Linux only).
+"""
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.append(str(Path(__file__).parent.parent))
+from services import visualization
+from services.visualization import (BASE_GRAPH_PATH, OUTPUT_SIZE, PLOT_LEFT, PLOT_RIGHT, PLOT_TOP,
+                                    PLOT_BOTTOM, PNG_COMPRESS_LEVEL, visualize_emotion)
+
+CALLS = 20
+
+
+def original_render(base, valence, arousal):
+    img = base.copy()
+    draw = ImageDraw.Draw(img)
+    x = PLOT_LEFT + valence * (PLOT_RIGHT - PLOT_LEFT)
+    y = PLOT_BOTTOM - arousal * (PLOT_BOTTOM - PLOT_TOP)
+    draw.ellipse([x - 25, y - 25, x + 25, y + 25], fill='red', outline='darkred', width=3)
+    buf = BytesIO()
+    img.resize((OUTPUT_SIZE, OUTPUT_SIZE), Image.LANCZOS).save(buf, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buf
+
+
+def memory_kib(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def measure(name, render, points):
+    # writing 5 to clear_refs resets the peak RSS (VmHWM) counter
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    baseline = memory_kib('VmRSS')
+
+    start = time.perf_counter()
+    for valence, arousal in points:
+        render(valence, arousal)
+    elapsed = (time.perf_counter() - start) / len(points)
+
+    peak = memory_kib('VmHWM') - baseline
+    print(f"{name:22s} {elapsed * 1000:8.1f} ms/call   peak RSS +{peak / 1024:6.1f} MiB")
+
+
+def main():
+    base = Image.open(BASE_GRAPH_PATH).convert('RGBA')
+    points = np.random.default_rng(0).uniform(0, 1, size=(CALLS, 2))
+
+    measure('original (marker only)', lambda v, a: original_render(base, v, a), points)
+    for fmt in ('png', 'webp'):
+        visualization._render.cache_clear()
+        measure(f'compositing {fmt}', lambda v, a: visualize_emotion(v, a, fmt=fmt), points)
+        measure(f'memoized {fmt}', lambda v, a: visualize_emotion(v, a, fmt=fmt), points)
+
+
+if __name__ == '__main__':
+    main()
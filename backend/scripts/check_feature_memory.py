@@ -0,0 +1,86 @@
+"""Compare the peak memory allocated by the standard and lean extraction modes.
+
+Runs get_features on synthesized clips (tone, noise and clicks) in both EXTRACTION_MODEs
+under tracemalloc, which sees every NumPy allocation, and reports for each:
+
+  first     peak allocated by the first call, including the lean arena's buffers
+  steady    peak allocated by a later call, once the arena holds its buffers
+  arena     scratch memory the lean mode keeps between requests
+  drift     worst relative change of any lean feature against the standard one
+  mood      largest change of the normalized valence or arousal the models give
+
+Exits non-zero if the lean steady peak is not at least --min-reduction times smaller than
+the standard one, or if it moves the mood by more than --max-mood-drift.
+
+    python scripts/check_feature_memory.py --seconds 45
+"""
+import io
+import sys
+import argparse
+import tracemalloc
+import contextlib
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from benchmark import encode, synthesize
+from services.getfeatures import EXTRACTION_MODES, FEATURE_NAMES, get_features
+from services.leanfeatures import buffer_arena
+from services.getmood import get_moods
+
+SR = 22050
+SIGNALS = ('tone+clicks', 'noise', 'tone+noise+clicks')
+ATOL = 1e-5
+
+
+def peak_mib(data, mode):
+    tracemalloc.start()
+    try:
+        features = get_features(data, mode=mode)
+        return features, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def mood(features):
+    with contextlib.redirect_stdout(io.StringIO()):  # get_moods' model notice
+        result = get_moods(features)[0]
+    return np.array([result.valence, result.arousal])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=int, default=45)
+    parser.add_argument('--min-reduction', type=float, default=2.0)
+    parser.add_argument('--max-mood-drift', type=float, default=0.001)
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'clip':20s} {'mode':9s} {'first':>9s} {'steady':>9s} {'arena':>9s}  "
+          f"{'worst drift':>11s} {'feature':26s} {'mood':>6s}")
+    for signal in SIGNALS:
+        data = encode(synthesize(signal, args.seconds, SR, channels=1), SR, 'WAV')
+        runs = {}
+        for mode in EXTRACTION_MODES:
+            buffer_arena().buffers.clear()  # every clip starts from an empty arena
+            features, first = peak_mib(data, mode)
+            _, steady = peak_mib(data, mode)
+            runs[mode] = (features, first, steady, buffer_arena().nbytes / 2 ** 20 if mode == 'lean' else 0.0)
+
+        reference = runs['standard'][0]
+        for mode, (features, first, steady, arena) in runs.items():
+            drift = np.abs(features - reference)[0] / (np.abs(reference)[0] + ATOL)
+            worst = int(np.argmax(drift))
+            mood_drift = np.max(np.abs(mood(features) - mood(reference)))
+            flag = ''
+            if mode == 'lean' and (runs['standard'][2] / steady < args.min_reduction or mood_drift > args.max_mood_drift):
+                flag, failed = '  FAIL', True
+            print(f"{signal:20s} {mode:9s} {first:6.1f}MiB {steady:6.1f}MiB {arena:6.1f}MiB  "
+                  f"{drift[worst]:11.2e} {FEATURE_NAMES[worst]:26s} {mood_drift:6.4f}{flag}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Check that the shared-STFT extractor matches the original per-feature librosa calls.
+
+Synthesizes a few clips (tones, noise, clicks), runs both implementations on each
+and fails if any of the 89 features drifts beyond tolerance. Also prints timings.
+"""
+import sys
+import time
+from pathlib import Path
+
+import librosa
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from services.getfeatures import extract_features
+
+SR = 22050
+RTOL = 1e-4
+ATOL = 1e-5
+
+
+# the original get_features body: every call recomputes its own transform
+def reference_features(y, sr=SR):
+    zcr = librosa.feature.zero_crossing_rate(y)
+    rms = librosa.feature.rms(y=y)
+    spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
+    spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
+    spectral_rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)
+    spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
+    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+    chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+    tonnetz = librosa.feature.tonnetz(y=y, sr=sr)
+    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
+    y_harmonic, y_percussive = librosa.effects.hpss(y)
+
+    return np.concatenate([
+        [np.mean(zcr), np.std(zcr), np.mean(rms), np.std(rms)],
+        [np.mean(spectral_centroid), np.std(spectral_centroid),
+         np.mean(spectral_bandwidth), np.std(spectral_bandwidth),
+         np.mean(spectral_rolloff), np.std(spectral_rolloff)],
+        np.mean(spectral_contrast, axis=1), np.std(spectral_contrast, axis=1),
+        np.atleast_1d(tempo)[:1],
+        np.mean(chroma, axis=1), np.std(chroma, axis=1),
+        np.mean(tonnetz, axis=1), np.std(tonnetz, axis=1),
+        np.mean(mfcc, axis=1), np.std(mfcc, axis=1),
+        [np.mean(np.abs(y_harmonic)) / (np.mean(np.abs(y)) + 1e-6),
+         np.mean(np.abs(y_percussive)) / (np.mean(np.abs(y)) + 1e-6)]
+    ])
+
+
+def synth_clips(seconds=20):
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * SR)) / SR
+    chord = sum(np.sin(2 * np.pi * f * t) for f in (220.0, 277.2, 329.6)) / 3
+    clicks = np.zeros_like(t)
+    clicks[::SR // 2] = 1.0  # 120 BPM
+    clicks = np.convolve(clicks, np.hanning(64), mode='same')
+    return {
+        'tone': 0.5 * np.sin(2 * np.pi * 440 * t),
+        'noise': 0.2 * rng.standard_normal(len(t)),
+        'chord+clicks': 0.4 * chord + 0.5 * clicks + 0.01 * rng.standard_normal(len(t)),
+    }
+
+
+def main():
+    failed = False
+    for name, y in synth_clips().items():
+        y = y.astype(np.float32)
+        extract_features(y, SR)  # warm numba caches before timing
+
+        start = time.perf_counter()
+        expected = reference_features(y)
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = extract_features(y, SR)
+        engine_time = time.perf_counter() - start
+
+        ok = actual.shape == (89,) and np.allclose(actual, expected, rtol=RTOL, atol=ATOL)
+        worst = np.max(np.abs(actual - expected) / (np.abs(expected) + ATOL))
+        print(f"{name:14s} {'ok' if ok else 'MISMATCH':8s} worst rel err {worst:.2e}  "
+              f"reference {reference_time:.2f}s  shared-stft {engine_time:.2f}s")
+        failed |= not ok
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
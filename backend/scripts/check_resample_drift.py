@@ -0,0 +1,96 @@
+"""Report the cost and feature drift of every resampling strategy against soxr_hq.
+
+Encodes synthesized clips (tone, noise and clicks) at the rates uploads usually come in,
+then for each RESAMPLE_STRATEGY runs get_features on the encoded bytes, the way a request
+does, and reports:
+
+  decode / resample   median per-request stage times, from the same spans /metrics uses
+  total               median wall time of the whole get_features call
+  drift               worst relative change of any feature, and which one
+  mood                largest change of the normalized valence or arousal the models give
+
+against the soxr_hq features the models were trained on. Exits non-zero if a strategy
+moves the mood by more than --max-mood-drift.
+
+    python scripts/check_resample_drift.py --seconds 45 --repeats 5
+"""
+import io
+import sys
+import argparse
+import contextlib
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from benchmark import encode, synthesize
+from services.getfeatures import RESAMPLE_STRATEGIES, get_features, tier_feature_names
+from services.getmood import get_moods, load_models
+from services.metrics import start_trace
+
+RATES = (44100, 48000, 32000)
+SIGNALS = ('tone+clicks', 'noise', 'tone+noise+clicks')
+ATOL = 1e-5
+
+
+def run(data, strategy, tier):
+    trace = start_trace()
+    features = get_features(data, tier=tier, resample=strategy)
+    stages = {}
+    for stage, seconds in trace.spans:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+    return features, stages
+
+
+def mood(features, tier):
+    with contextlib.redirect_stdout(io.StringIO()):  # get_moods' model notice
+        result = get_moods(features, tier)[0]
+    return np.array([result.valence, result.arousal])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=int, default=45)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--tier', default='full', choices=['full', 'fast'])
+    parser.add_argument('--format', default='WAV', help='container the clips are encoded as')
+    parser.add_argument('--max-mood-drift', type=float, default=0.02)
+    args = parser.parse_args()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.tier not in load_models():
+            parser.error(f"no {args.tier} tier models to measure the mood drift with, train them with model/train_model.py")
+
+    names = tier_feature_names(args.tier)
+    failed = False
+    print(f"{'clip':28s} {'strategy':10s} {'decode':>8s} {'resample':>9s} {'total':>8s}  "
+          f"{'worst drift':>11s} {'feature':26s} {'mood':>6s}")
+    for sr in RATES:
+        for signal in SIGNALS:
+            y = synthesize(signal, args.seconds, sr, channels=2)
+            data = encode(y, sr, args.format)
+            clip = f"{signal}@{sr // 100 / 10:g}k"
+
+            reference = None
+            for strategy in RESAMPLE_STRATEGIES:
+                run(data, strategy, args.tier)  # warm up filters and numba before timing
+                samples = [run(data, strategy, args.tier) for _ in range(args.repeats)]
+                features = samples[0][0]
+                stage = lambda name: np.median([stages.get(name, 0.0) for _, stages in samples]) * 1000
+                total = np.median([sum(stages.values()) for _, stages in samples]) * 1000
+
+                if reference is None:
+                    reference = features
+                drift = np.abs(features - reference)[0] / (np.abs(reference)[0] + ATOL)
+                worst = int(np.argmax(drift))
+                mood_drift = np.max(np.abs(mood(features, args.tier) - mood(reference, args.tier)))
+                flag = ''
+                if mood_drift > args.max_mood_drift:
+                    flag, failed = '  DRIFT', True
+                print(f"{clip:28s} {strategy:10s} {stage('decode'):6.1f}ms {stage('resample'):7.1f}ms "
+                      f"{total:6.0f}ms  {drift[worst]:11.2e} {names[worst]:26s} {mood_drift:6.4f}{flag}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import os
+from typing import NamedTuple
+
+# Admission settings, overridable per deployment
+ADMISSION_TARGET = float(os.environ.get('ADMISSION_TARGET', 10))  # seconds of queueing + work before a request is degraded
+DEGRADED_WINDOW = float(os.environ.get('ADMISSION_DEGRADED_WINDOW', 15))  # analysis window once 'window' is applied
+
+# What a request gives up under pressure, least noticeable first; each step keeps the previous ones
+DEGRADATIONS = ('image', 'window', 'tier')
+
+# Rough single-core costs, in seconds. The pool measures how long jobs really take and
+# rescales these (AnalysisPool.scale), so only their proportions need to be right
+EXTRACT_SECONDS = {'full': 0.085, 'fast': 0.008}  # per second of analyzed audio
+RESAMPLE_SECONDS = 8e-9  # per input sample, for files not at the analysis rate
+IMAGE_SECONDS = 0.07  # rendering and encoding an inline plot
+JOB_SECONDS = 0.02  # per job: pickling, prediction
+
+
+# How admit() serves a request
+class Plan(NamedTuple):
+    window: float
+    tier: str
+    image: str
+    degraded: list  # degradations applied, in DEGRADATIONS order
+    cost: float  # job seconds before scaling
+
+
+# (duration, sample rate, channels) of audio decode_audio has already mixed down
+def decoded_header(audio):
+    y, file_sr = audio
+    return len(y) / file_sr, file_sr, 1
+
+
+# seconds of audio the analysis covers, the whole window when the header doesn't say
+def _analyzed(header, window):
+    duration = header[0]
+    return window if duration is None else min(duration, window)
+
+
+# what the pool job costs: resampling and extracting `window` seconds, plus the plot
+def job_cost(header, window=45, tier='full', image='inline', sr=22050):
+    _, file_sr, _ = header
+    seconds = _analyzed(header, window)
+    cost = JOB_SECONDS + EXTRACT_SECONDS[tier] * seconds
+    if file_sr != sr:
+        cost += RESAMPLE_SECONDS * seconds * file_sr
+    if image == 'inline':
+        cost += IMAGE_SECONDS
+    return cost
+
+
+# The least degraded Plan that serves a request within `target` seconds, given `wait`
+# seconds of pool work already ahead of it and `scale` (measured / estimated job time), or
+# None when even the cheapest variant would miss the target and the request should be shed.
+# `tiers` are the ones the models were trained for, the full tier is only given up for those
+def admit(header, wait, scale=1.0, window=45, tier='full', image='inline', target=ADMISSION_TARGET,
+          tiers=('full', 'fast')):
+    degraded = []
+    for step in (None,) + DEGRADATIONS:
+        if step == 'image' and image == 'inline':
+            image = 'none'  # 'url' plots are rendered by GET /plot, outside the pool
+        elif step == 'window' and window > DEGRADED_WINDOW and _analyzed(header, window) > DEGRADED_WINDOW:
+            window = DEGRADED_WINDOW
+        elif step == 'tier' and tier == 'full' and 'fast' in tiers:
+            tier = 'fast'
+        elif step is not None:
+            continue  # nothing to give up at this step
+        if step is not None:
+            degraded.append(step)
+
+        cost = job_cost(header, window, tier, image)
+        if wait + cost * scale <= target:
+            return Plan(window, tier, image, degraded, cost)
+    return None
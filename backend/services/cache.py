@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+import hashlib
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+from services.getfeatures import decode_audio
+from services.metrics import span
+
+# Cache settings, overridable per deployment
+CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 256))
+CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 24 * 3600))
+CACHE_DB = os.environ.get('RESULT_CACHE_DB')  # unset keeps the cache in memory only
+CACHE_DB_SIZE = int(os.environ.get('RESULT_CACHE_DB_SIZE', 10000))
+
+
+# hashes the decoded PCM rather than the upload, so a WAV and a FLAC of the same audio share a key
+def audio_key(audio_file, duration=45):
+    try:
+        if isinstance(audio_file, tuple):
+            y, file_sr = audio_file
+        else:
+            y, file_sr = decode_audio(audio_file, duration=duration)
+    except Exception as e:
+        print(f"Audio hashing failed: {e}")
+        return None
+
+    with span('cache_key'):
+        digest = hashlib.sha256(f"{file_sr}:{duration}:".encode())
+        digest.update(np.ascontiguousarray(y).tobytes())
+        return digest.hexdigest()
+
+
+# Keys carry the label (version@artifact fingerprint) of the models that produced the result,
+# so replaced models miss on their own and their old entries age out with the LRU and TTL
+class ResultCache:
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, db_path=CACHE_DB, db_size=CACHE_DB_SIZE):
+        self.size = size
+        self.ttl = ttl
+        self.db_size = db_size
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (stored_at, value), oldest first
+        self._lock = threading.Lock()  # get and put run in the server's threadpool
+        self._db = None
+
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT, stored_at REAL, used_at REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)")
+
+    def _remember(self, key, stored_at, value):
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            now = time.time()
+
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT stored_at, value FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[0] <= self.ttl:
+                    with self._db:
+                        self._db.execute("UPDATE results SET used_at = ? WHERE key = ?", (now, key))
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[1]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            now = time.time()
+            self._remember(key, now, value)
+
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        # named columns, databases from before keys carried the model label have a fingerprint column
+                        "INSERT OR REPLACE INTO results (key, value, stored_at, used_at) VALUES (?, ?, ?, ?)",
+                        (key, value, now, now)
+                    )
+                    self._db.execute("DELETE FROM results WHERE stored_at < ?", (now - self.ttl,))
+                    # least recently used rows go first once the table is over size
+                    self._db.execute(
+                        "DELETE FROM results WHERE key IN "
+                        "(SELECT key FROM results ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                        (self.db_size,)
+                    )
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._memory),
+        }
@@ -0,0 +1,180 @@
+import hashlib
+import numpy as np
+
+# Every tree is padded to a complete binary tree of the ensemble's max depth and stored
+# in heap order, so the children of split i are always 2i+1 and 2i+2 and a sample takes
+# exactly `depth` steps. Padding splits always go left and copy the leaf value down.
+NODE_DTYPE = np.dtype([
+    ('feature', np.int32),
+    ('threshold', np.float64),
+])
+BLOCK_ROWS = 64  # rows evaluated together, keeps the (trees, rows) work arrays in cache
+MAX_DEPTH = 12  # padded tables grow as 2^depth per tree, deeper ensembles aren't compiled
+
+
+class TreeTooDeep(ValueError):
+    pass
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# A tree as (left, right, feature, threshold, leaf value, max depth) arrays, left is -1 at
+# leaves and leaf values are what the model adds per tree
+def _trees(model):
+    if hasattr(model, 'estimators_'):  # GradientBoostingRegressor
+        for estimator in model.estimators_[:, 0]:
+            tree = estimator.tree_
+            # same product sklearn's predict_stages adds per tree
+            values = model.learning_rate * tree.value[:, 0, 0]
+            yield tree.children_left, tree.children_right, tree.feature, tree.threshold, values, tree.max_depth
+    else:  # HistGradientBoostingRegressor: leaf values already include the learning rate
+        for (predictor,) in model._predictors:
+            nodes = predictor.nodes
+            left = np.where(nodes['is_leaf'], -1, nodes['left'].astype(np.intp))
+            yield left, nodes['right'], nodes['feature_idx'], nodes['num_threshold'], nodes['value'], predictor.get_max_depth()
+
+
+def _fill_tree(tree, depth, nodes, leaves, source=0, slot=0, level=0):
+    left, right, feature, threshold, values, _ = tree
+    if left[source] == -1:
+        # a leaf above the bottom level covers a contiguous run of bottom slots
+        span = 2 ** (depth - level)
+        first = (slot + 1) * span - 1 - (2 ** depth - 1)
+        leaves[first:first + span] = values[source]
+        return
+
+    nodes[slot] = (feature[source], threshold[source])
+    _fill_tree(tree, depth, nodes, leaves, left[source], 2 * slot + 1, level + 1)
+    _fill_tree(tree, depth, nodes, leaves, right[source], 2 * slot + 2, level + 1)
+
+
+# flattens fitted squared-error GradientBoostingRegressors or HistGradientBoostingRegressors
+# (all of one kind) into one node and leaf table. Early stopping can leave the models with
+# different numbers of trees, the shorter ones are padded with trees that add 0
+def compile_ensembles(models):
+    trees = [list(_trees(model)) for model in models]
+    depth = max(tree[5] for model_trees in trees for tree in model_trees)
+    if depth > MAX_DEPTH:
+        raise TreeTooDeep(
+            f"The models have trees {depth} levels deep, the compiled table takes at most {MAX_DEPTH} "
+            f"(it pads every tree to 2^depth leaves); train with a max_depth of {MAX_DEPTH} or less"
+        )
+    n_trees = max(len(model_trees) for model_trees in trees)
+
+    nodes = np.zeros((len(models), n_trees, 2 ** depth - 1), dtype=NODE_DTYPE)
+    nodes['threshold'] = np.inf
+    leaves = np.zeros((len(models), n_trees, 2 ** depth))
+    init = np.zeros(len(models))
+
+    for k, model in enumerate(models):
+        init[k] = np.ravel(model.init_.constant_ if hasattr(model, 'init_') else model._baseline_prediction)[0]
+        for t, tree in enumerate(trees[k]):
+            _fill_tree(tree, depth, nodes[k, t], leaves[k, t])
+
+    return nodes, leaves, init
+
+
+# the dtype the models compare features in: regression trees cast inputs to float32, the
+# histogram models split float64 values
+def input_dtype(models):
+    return 'float32' if hasattr(models[0], 'estimators_') else 'float64'
+
+
+# the models' fitted column names, the feature schema version and the fitted StandardScaler's
+# statistics are stored alongside, so serving needs neither sklearn nor the joblib files
+def save_compiled(path, models, names, sources=(), schema_version=None, scaler=None):
+    nodes, leaves, init = compile_ensembles(models)
+    extra = {}
+    if scaler is not None:
+        extra['scaler_mean'] = scaler.mean_
+        extra['scaler_scale'] = scaler.scale_
+    if hasattr(models[0], 'feature_names_in_'):
+        extra['feature_names'] = np.array(models[0].feature_names_in_, dtype=str)
+    if schema_version is not None:
+        extra['schema_version'] = np.array(schema_version)
+    np.savez(
+        path,
+        nodes=nodes,
+        leaves=leaves,
+        init=init,
+        input_dtype=np.array(input_dtype(models)),
+        n_features=np.array(models[0].n_features_in_),
+        names=np.array(names),
+        sources=np.array([file_digest(source) for source in sources]),
+        **extra,
+    )
+
+
+class CompiledEnsemble:
+    def __init__(self, nodes, leaves, init, n_features, names, sources=(), feature_names=None, schema_version=None,
+                 scaler_mean=None, scaler_scale=None, input_dtype='float32'):
+        self.n_targets, self.n_trees, n_splits = nodes.shape
+        self.depth = int(np.log2(n_splits + 1))
+        # flat contiguous copies index much faster than strided record views
+        self.feature = np.ascontiguousarray(nodes['feature'].ravel(), dtype=np.intp)
+        self.threshold = np.ascontiguousarray(nodes['threshold'].ravel())
+        self.leaves = np.ascontiguousarray(leaves.ravel())
+        self.init = init
+        self.n_features = int(n_features)
+        self.names = [str(name) for name in names]
+        self.sources = [str(source) for source in sources]
+        # same attribute names as sklearn estimators, for getfeatures.check_schema
+        self.feature_names_in_ = None if feature_names is None else [str(name) for name in feature_names]
+        self.feature_schema_version_ = None if schema_version is None else int(schema_version)
+        self.scaler_mean = scaler_mean
+        self.scaler_scale = scaler_scale
+        self.input_dtype = np.dtype(str(input_dtype))
+
+        n_all = self.n_targets * self.n_trees
+        self._split_base = (np.arange(n_all) * n_splits)[:, np.newaxis]
+        self._leaf_base = (np.arange(n_all) * 2 ** self.depth - n_splits)[:, np.newaxis]
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    # True if the artifact was compiled from exactly these joblib files
+    def matches(self, sources):
+        return self.sources == [file_digest(source) for source in sources]
+
+    @property
+    def has_scaler(self):
+        return self.scaler_mean is not None
+
+    # same two in-place steps as StandardScaler.transform, so the output is identical
+    def scale(self, X):
+        X = np.array(X, dtype=np.float64)
+        X -= self.scaler_mean
+        X /= self.scaler_scale
+        return X
+
+    def _predict_block(self, X):
+        n = len(X)
+        # feature-major so one flat take fetches each sample's split feature
+        columns = np.ascontiguousarray(X.T).ravel()
+        offsets = np.arange(n)[np.newaxis, :]
+
+        node = np.zeros((len(self._split_base), n), dtype=np.intp)
+        for _ in range(self.depth):
+            split = self._split_base + node
+            lookup = np.take(self.feature, split) * n + offsets
+            go_left = np.take(columns, lookup) <= np.take(self.threshold, split)
+            node = 2 * node + 2 - go_left
+
+        values = np.take(self.leaves, self._leaf_base + node)
+        values = values.reshape(self.n_targets, self.n_trees, n)
+        # accumulate is strictly left to right, so the sums match sklearn's tree-by-tree adds
+        stages = np.concatenate([np.broadcast_to(self.init[:, None, None], (self.n_targets, 1, n)), values], axis=1)
+        return np.add.accumulate(stages, axis=1)[:, -1, :].T
+
+    # predicts every target for a (n, n_features) batch, returns (n, n_targets)
+    def predict(self, X):
+        # the features in the precision the models compared them in, against float64 thresholds
+        X = np.ascontiguousarray(X, dtype=self.input_dtype)
+        return np.concatenate([
+            self._predict_block(X[start:start + BLOCK_ROWS]) for start in range(0, len(X), BLOCK_ROWS)
+        ]) if len(X) else np.empty((0, self.n_targets))
@@ -0,0 +1,67 @@
+import numpy as np
+
+GRID_SIZE = 256  # cells per axis over the [0, 1] valence/arousal square
+TOP_K = 3
+BLOCK_ROWS = 65536  # points ranked together, bounds the (points, candidates, 2) work arrays
+
+
+# Nearest-emotion lookup for many points at once. The unit square is cut into a grid and
+# every cell keeps the few emotions that can be among the TOP_K nearest anywhere inside it:
+# those within the cell center's K-th nearest distance plus a cell diagonal. A point then only
+# measures its distance to its cell's candidates (usually 3-6 instead of every emotion), and
+# the result is exactly what measuring against all of them gives. Points outside the square
+# fall back to every emotion
+class EmotionIndex:
+    def __init__(self, coordinates, grid_size=GRID_SIZE):
+        if len(coordinates) < TOP_K:
+            raise ValueError(f"Need at least {TOP_K} emotions, got {len(coordinates)}")
+        self.labels = np.array(list(coordinates))
+        self.coords = np.array(list(coordinates.values()), dtype=np.float64).reshape(-1, 2)
+        if not np.all(np.isfinite(self.coords)):
+            raise ValueError("Emotion coordinates must be finite numbers")
+        self.grid_size = grid_size
+
+        centers = (np.stack(np.meshgrid(np.arange(grid_size), np.arange(grid_size)), axis=-1).reshape(-1, 2) + 0.5) / grid_size
+        distances = np.linalg.norm(centers[:, np.newaxis, :] - self.coords[np.newaxis, :, :], axis=2)
+        kth = np.partition(distances, TOP_K - 1, axis=1)[:, TOP_K - 1:TOP_K]
+        candidate = distances <= kth + np.sqrt(2) / grid_size
+
+        # (cells, most candidates) emotion indices in ascending order, padded with an extra
+        # emotion at infinity that is never among the nearest
+        width = candidate.sum(axis=1).max()
+        order = np.argsort(~candidate, axis=1, kind='stable')[:, :width]
+        self.candidates = np.where(np.take_along_axis(candidate, order, axis=1), order, len(self.coords)).astype(np.int16)
+        self.padded = np.vstack([self.coords, [np.inf, np.inf]])
+
+    # labels (n, 3) and percentages (n, 3) of the 3 nearest emotions for (n, 2) points
+    def rank(self, points):
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        distances = np.empty((len(points), TOP_K))
+        top_idx = np.empty((len(points), TOP_K), dtype=np.intp)
+        for start in range(0, len(points), BLOCK_ROWS):
+            block = slice(start, start + BLOCK_ROWS)
+            self._nearest(points[block], distances[block], top_idx[block])
+
+        weights = 1 / (1 + distances)
+        percentages = (weights / np.sum(weights, axis=1, keepdims=True)) * 100
+        return self.labels[top_idx], percentages
+
+    def _nearest(self, points, distances, top_idx):
+        inside = np.all((points >= 0) & (points <= 1), axis=1)
+        if inside.all():
+            groups = [(slice(None), self._cell_candidates(points))]
+        else:
+            everything = np.arange(len(self.coords))
+            groups = [(inside, self._cell_candidates(points[inside])),
+                      (~inside, np.broadcast_to(everything, (np.count_nonzero(~inside), len(everything))))]
+
+        for rows, candidates in groups:
+            d = np.linalg.norm(points[rows][:, np.newaxis, :] - self.padded[candidates], axis=2)
+            # candidates are in emotion order, so ties go to the earlier emotion either way
+            nearest = np.argsort(d, axis=1, kind='stable')[:, :TOP_K]
+            distances[rows] = np.take_along_axis(d, nearest, axis=1)
+            top_idx[rows] = np.take_along_axis(candidates, nearest, axis=1)
+
+    def _cell_candidates(self, points):
+        cell = np.minimum((points * self.grid_size).astype(np.intp), self.grid_size - 1)
+        return self.candidates[cell[:, 1] * self.grid_size + cell[:, 0]]
@@ -1,86 +1,291 @@
+import os
 import librosa
+import soxr
 import soundfile as sf
 import numpy as np
 from io import BytesIO
+from services.metrics import span
 
+# STFT settings shared by every spectral feature (librosa defaults)
+N_FFT = 2048
+HOP_LENGTH = 512
+BLOCK_FRAMES = 65536  # frames decoded per read
+
+# How uploads at other rates get to the analysis rate: 'soxr_hq' (librosa's default, what the
+# models were trained on), the faster 'soxr_mq' / 'soxr_lq', 'polyphase' (scipy's polyphase
+# filter, exact integer ratios like 44.1k -> 22.05k) or 'decode', which resamples each block
+# as it is decoded so the full-rate window is never held. scripts/check_resample_drift.py
+# reports the time and feature drift of each against soxr_hq
+RESAMPLE_STRATEGIES = ('soxr_hq', 'soxr_mq', 'soxr_lq', 'polyphase', 'decode')
+RESAMPLE_STRATEGY = os.environ.get('RESAMPLE_STRATEGY', 'soxr_hq')
+if RESAMPLE_STRATEGY not in RESAMPLE_STRATEGIES:
+    # checked at import so a typo stops startup instead of failing every upload
+    raise ValueError(f"RESAMPLE_STRATEGY={RESAMPLE_STRATEGY!r} is not one of {RESAMPLE_STRATEGIES}")
+
+# 'standard' extracts in librosa's float64 as the models were trained; 'lean' computes the same
+# features in float32 into scratch buffers reused across requests, for memory-tight workers
+# (services/leanfeatures.py, imported only when used: numba and scipy add ~1.4 s to startup).
+# scripts/check_feature_memory.py reports the peak allocation and feature drift of both
+EXTRACTION_MODES = ('standard', 'lean')
+EXTRACTION_MODE = os.environ.get('EXTRACTION_MODE', 'standard')
+if EXTRACTION_MODE not in EXTRACTION_MODES:
+    raise ValueError(f"EXTRACTION_MODE={EXTRACTION_MODE!r} is not one of {EXTRACTION_MODES}")
+
+# Feature schema: named groups in vector order. Bump the version whenever a name, the
+# order or how a value is computed changes, fitted scalers and models are checked against it
+FEATURE_SCHEMA_VERSION = 1
+FEATURE_GROUPS = {
+    'temporal': ['zcr_mean', 'zcr_std', 'rms_mean', 'rms_std'],
+    'spectral': (
+        ['spectral_centroid_mean', 'spectral_centroid_std',
+         'spectral_bandwidth_mean', 'spectral_bandwidth_std',
+         'spectral_rolloff_mean', 'spectral_rolloff_std'] +
+        [f'spectral_contrast_{i}_mean' for i in range(7)] +
+        [f'spectral_contrast_{i}_std' for i in range(7)]
+    ),
+    'rhythm': ['tempo'],
+    'chroma': [f'chroma_{i}_mean' for i in range(12)] + [f'chroma_{i}_std' for i in range(12)],
+    'tonnetz': [f'tonnetz_{i}_mean' for i in range(6)] + [f'tonnetz_{i}_std' for i in range(6)],
+    'timbre': [f'mfcc_{i}_mean' for i in range(1, 14)] + [f'mfcc_{i}_std' for i in range(1, 14)],
+    'harmonic_percussive': ['harmonic_ratio', 'percussive_ratio'],
+}
+FEATURE_NAMES = [name for names in FEATURE_GROUPS.values() for name in names]
+FEATURE_DTYPE = np.dtype(np.float64)
+
+# Extraction tiers: the groups each one computes, in schema order. 'fast' skips HPSS
+# (~3 s on a 45 s clip) and tonnetz's constant-Q transform (~0.3 s) and is served by
+# models trained on just its columns
+FEATURE_TIERS = {
+    'full': list(FEATURE_GROUPS),
+    'fast': ['temporal', 'spectral', 'rhythm', 'chroma', 'timbre'],
+}
+
+
+def tier_feature_names(tier='full'):
+    return [name for group in FEATURE_TIERS[tier] for name in FEATURE_GROUPS[group]]
+
+
+class FeatureSchemaError(Exception):
+    pass
+
+
+def feature_schema(tier='full'):
+    return {'version': FEATURE_SCHEMA_VERSION, 'tier': tier, 'names': tier_feature_names(tier), 'dtype': FEATURE_DTYPE.name}
+
+
+# raises if a fitted scaler or model was built for another feature layout; artifacts from
+# before versioning carry no version, for those the fitted column names are compared
+def check_schema(artifact, name, tier='full'):
+    version = getattr(artifact, 'feature_schema_version_', None)
+    names = getattr(artifact, 'feature_names_in_', None)
+    if version is not None and version != FEATURE_SCHEMA_VERSION:
+        raise FeatureSchemaError(
+            f"{name} was built for feature schema v{version}, the extractor is v{FEATURE_SCHEMA_VERSION}"
+        )
+    if names is not None and list(names) != tier_feature_names(tier):
+        raise FeatureSchemaError(f"{name} was fitted on different feature columns than the extractor produces")
+    if version is None and names is None:
+        raise FeatureSchemaError(f"{name} has no feature schema version or column names to check")
+
+
+# decodes the first `duration` seconds to mono float32, block by block so only the mono
+# analysis window is ever held in memory. At the file's own rate, or with `sr` each block
+# is resampled as soon as it's decoded (soxr's streaming HQ resampler, soxr_hq's filter)
+def decode_audio(audio_file, duration=45, sr=None):
+    if isinstance(audio_file, bytes):
+        audio_file = BytesIO(audio_file)
+
+    with span('decode'), sf.SoundFile(audio_file) as f:
+        file_sr = f.samplerate
+        frames_to_read = min(len(f), int(duration * file_sr))
+        blocks = f.blocks(blocksize=BLOCK_FRAMES, frames=frames_to_read, dtype='float32', always_2d=True)
+
+        if sr is not None and sr != file_sr:
+            resampler = soxr.ResampleStream(file_sr, sr, 1, dtype='float32', quality='HQ')
+            parts = [resampler.resample_chunk(np.mean(block, axis=1) if block.shape[1] > 1 else block[:, 0])
+                     for block in blocks]
+            parts.append(resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True))
+            return np.concatenate(parts), sr
+
+        y = np.empty(frames_to_read, dtype=np.float32)
+        pos = 0
+        for block in blocks:
+            y[pos:pos + len(block)] = np.mean(block, axis=1) if block.shape[1] > 1 else block[:, 0]
+            pos += len(block)
+
+    return y[:pos], file_sr
+
+
+# the rate to ask decode_audio for: the analysis rate when the strategy resamples while decoding
+def decode_rate(sr=22050, strategy=RESAMPLE_STRATEGY):
+    return sr if strategy == 'decode' else None
 
-# extracts features from song, same features that were used
-def get_features(audio_file, duration=45, sr=22050):
-    try:
-        if isinstance(audio_file, bytes):
-            audio_file = BytesIO(audio_file)
 
-        with sf.SoundFile(audio_file) as f:
-            file_sr = f.samplerate
-            frames_to_read = min(len(f), int(duration * file_sr))
-            y = f.read(frames=frames_to_read, dtype='float32', always_2d=False)
+# `audio_file` can also be an already decoded (samples, samplerate) pair from decode_audio
+def load_audio(audio_file, duration=45, sr=22050, resample=RESAMPLE_STRATEGY):
+    if resample not in RESAMPLE_STRATEGIES:
+        raise ValueError(f"Unknown resampling strategy {resample!r}, expected one of {RESAMPLE_STRATEGIES}")
 
-        if y.ndim > 1:
-            y = np.mean(y, axis=1)
+    if isinstance(audio_file, tuple):
+        y, file_sr = audio_file
+    else:
+        y, file_sr = decode_audio(audio_file, duration=duration, sr=decode_rate(sr, resample))
 
-        if file_sr != sr:
-            y = librosa.resample(y, orig_sr=file_sr, target_sr=sr)
+    if file_sr != sr:
+        with span('resample'):
+            # 'decode' only applies to files decoded here, pairs decoded at their own rate use HQ
+            y = librosa.resample(y, orig_sr=file_sr, target_sr=sr, res_type='soxr_hq' if resample == 'decode' else resample)
 
-        if len(y) == 0 or np.max(np.abs(y)) < 0.001:
-            return None
+    return y
 
-        # Temporal features (4)
-        zcr = librosa.feature.zero_crossing_rate(y)
-        zcr_mean, zcr_std = np.mean(zcr), np.std(zcr)
 
-        rms = librosa.feature.rms(y=y)
-        rms_mean, rms_std = np.mean(rms), np.std(rms)
+# frame-wise RMS from a running sum of squares, same framing as librosa.feature.rms(y=y)
+def _rms(y):
+    pad = N_FFT // 2
+    power = np.concatenate([[0.0], np.cumsum(np.square(y, dtype=np.float64))])
+    n_frames = 1 + len(y) // HOP_LENGTH
+    starts = np.arange(n_frames) * HOP_LENGTH - pad
+    lo = np.clip(starts, 0, len(y))
+    hi = np.clip(starts + N_FFT, 0, len(y))
+    return np.sqrt((power[hi] - power[lo]) / N_FFT)
 
-        # Spectral features (22)
-        spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
-        sc_mean, sc_std = np.mean(spectral_centroid), np.std(spectral_centroid)
 
-        spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
-        sb_mean, sb_std = np.mean(spectral_bandwidth), np.std(spectral_bandwidth)
+def is_silent(y):
+    return len(y) == 0 or np.max(np.abs(y)) < 0.001
 
-        spectral_rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)
-        sr_mean, sr_std = np.mean(spectral_rolloff), np.std(spectral_rolloff)
 
-        spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
-        contrast_mean = np.mean(spectral_contrast, axis=1)
-        contrast_std = np.std(spectral_contrast, axis=1)
+# same estimate beat_track returns for its tempo, without running the beat tracker itself
+def _tempo(onset_env, sr):
+    if not onset_env.any():
+        return np.zeros(1)
+    return np.atleast_1d(librosa.feature.tempo(onset_envelope=onset_env, sr=sr, hop_length=HOP_LENGTH))[:1]
 
-        # Rhythm features (1)
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
 
-        # Tonal/Harmonic features (36)
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-        chroma_mean = np.mean(chroma, axis=1)
-        chroma_std = np.std(chroma, axis=1)
+# the per-frame values every feature of the tier is summarized from, computed once per signal
+# from one shared STFT, mel spectrogram and HPSS: a list of (k, frames) arrays for each
+# mean/std group, the onset envelope for tempo and the |signal|, |harmonic| and |percussive|
+# samples for the ratios. Every feature family is timed as its own 'feature.<name>' stage
+def frame_features(y, sr=22050, tier='full'):
+    wanted = FEATURE_TIERS[tier]
+    frames = {}
 
-        tonnetz = librosa.feature.tonnetz(y=y, sr=sr)
-        tonnetz_mean = np.mean(tonnetz, axis=1)
-        tonnetz_std = np.std(tonnetz, axis=1)
+    # Shared intermediates
+    with span('feature.stft'):
+        stft = librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH)
+        S = np.abs(stft)
+        S_power = S ** 2
+    with span('feature.mel'):
+        mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S_power, sr=sr))
 
-        # Timbre features (26)
-        mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-        mfcc_mean = np.mean(mfcc, axis=1)
-        mfcc_std = np.std(mfcc, axis=1)
+    # Temporal features (4)
+    with span('feature.temporal'):
+        zcr = librosa.feature.zero_crossing_rate(y, frame_length=N_FFT, hop_length=HOP_LENGTH)
+        frames['temporal'] = [zcr, _rms(y)[np.newaxis, :]]
 
+    # Spectral features (22)
+    with span('feature.spectral'):
+        spectral_centroid = librosa.feature.spectral_centroid(S=S, sr=sr)
+        frames['spectral'] = [
+            spectral_centroid,
+            librosa.feature.spectral_bandwidth(S=S, sr=sr, centroid=spectral_centroid),
+            librosa.feature.spectral_rolloff(S=S, sr=sr),
+            librosa.feature.spectral_contrast(S=S, sr=sr),
+        ]
+
+    # Rhythm features (1)
+    with span('feature.rhythm'):
+        frames['rhythm'] = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=HOP_LENGTH, aggregate=np.median)
+
+    # Tonal/Harmonic features (24 + 12)
+    with span('feature.chroma'):
+        frames['chroma'] = [librosa.feature.chroma_stft(S=S_power, sr=sr)]
+
+    if 'tonnetz' in wanted:
+        with span('feature.tonnetz'):
+            # tonnetz needs a constant-Q chroma, which can't be derived from the STFT
+            frames['tonnetz'] = [librosa.feature.tonnetz(y=y, sr=sr)]
+
+    # Timbre features (26)
+    with span('feature.timbre'):
+        frames['timbre'] = [librosa.feature.mfcc(S=mel_db, n_mfcc=13)]
+
+    if 'harmonic_percussive' in wanted:
         # Harmonic/Percussive features (2)
-        y_harmonic, y_percussive = librosa.effects.hpss(y)
-        harmonic_ratio = np.mean(np.abs(y_harmonic)) / (np.mean(np.abs(y)) + 1e-6)
-        percussive_ratio = np.mean(np.abs(y_percussive)) / (np.mean(np.abs(y)) + 1e-6)
-
-        # Combine in exact training order
-        features = np.concatenate([
-            [zcr_mean, zcr_std, rms_mean, rms_std],
-            [sc_mean, sc_std, sb_mean, sb_std, sr_mean, sr_std],
-            contrast_mean, contrast_std,
-            [tempo[0]],
-            chroma_mean, chroma_std,
-            tonnetz_mean, tonnetz_std,
-            mfcc_mean, mfcc_std,
-            [harmonic_ratio, percussive_ratio]
-        ])
-
-        return features.reshape(1, -1)  # Shape (1, 89) for model
+        with span('feature.harmonic_percussive'):
+            stft_harmonic, stft_percussive = librosa.decompose.hpss(stft)
+            y_harmonic = librosa.istft(stft_harmonic, hop_length=HOP_LENGTH, dtype=y.dtype, length=len(y))
+            y_percussive = librosa.istft(stft_percussive, hop_length=HOP_LENGTH, dtype=y.dtype, length=len(y))
+            frames['harmonic_percussive'] = (np.abs(y), np.abs(y_harmonic), np.abs(y_percussive))
+
+    return frames
+
+
+# computes the tier's features (all 89 for 'full'), laid out in schema order
+def extract_features(y, sr=22050, tier='full'):
+    frames = frame_features(y, sr=sr, tier=tier)
+    groups = {}
+    for group in FEATURE_TIERS[tier]:
+        if group == 'rhythm':
+            with span('feature.rhythm'):
+                groups[group] = _tempo(frames[group], sr)
+        elif group == 'harmonic_percussive':
+            abs_y, abs_harmonic, abs_percussive = frames[group]
+            groups[group] = [
+                np.mean(abs_harmonic) / (np.mean(abs_y) + 1e-6),
+                np.mean(abs_percussive) / (np.mean(abs_y) + 1e-6),
+            ]
+        else:
+            # mean then std of every row, one part after the other
+            groups[group] = np.concatenate([
+                stat for part in frames[group] for stat in (np.mean(part, axis=1), np.std(part, axis=1))
+            ])
+    return np.concatenate([groups[group] for group in FEATURE_TIERS[tier]]).astype(FEATURE_DTYPE)
+
+
+# runs every tier once on a short synthetic clip, so numba compiles librosa's JIT kernels
+# (onset detection, tempo, spectral peaks) before the first real request pays for it
+def warm_up(sr=22050):
+    t = np.arange(2 * sr) / sr
+    y = 0.1 * np.sin(2 * np.pi * 440 * t)
+    y[::sr // 4] = 1.0  # clicks, so tempo estimation has onsets to work with
+    extract = extract_features
+    if EXTRACTION_MODE == 'lean':
+        from services.leanfeatures import extract_features_lean as extract
+    for tier in FEATURE_TIERS:
+        extract(y.astype(np.float32), sr=sr, tier=tier)
+
+
+SILENT_AUDIO = 'silent or empty audio'
+
+
+# (features, None), or (None, why there are none): SILENT_AUDIO or the error that stopped
+# decoding or extraction, for callers that report failures per file
+def try_features(audio_file, duration=45, sr=22050, tier='full', resample=RESAMPLE_STRATEGY, mode=EXTRACTION_MODE):
+    try:
+        if mode not in EXTRACTION_MODES:
+            raise ValueError(f"Unknown extraction mode {mode!r}, expected one of {EXTRACTION_MODES}")
+        y = load_audio(audio_file, duration=duration, sr=sr, resample=resample)
+
+        if is_silent(y):
+            return None, SILENT_AUDIO
+
+        if mode == 'lean':
+            from services.leanfeatures import extract_features_lean
+            return extract_features_lean(y, sr=sr, tier=tier), None  # float32, already (1, 89)
+        return extract_features(y, sr=sr, tier=tier).reshape(1, -1), None  # Shape (1, 89) for the full model
 
     except Exception as e:
-        print(f"Feature extraction failed: {e}")
-        return None
+        return None, f"{type(e).__name__}: {e}"
+
+
+# extracts features from song, same features that were used
+def get_features(audio_file, duration=45, sr=22050, tier='full', resample=RESAMPLE_STRATEGY, mode=EXTRACTION_MODE):
+    features, reason = try_features(audio_file, duration=duration, sr=sr, tier=tier, resample=resample, mode=mode)
+    if reason is not None and reason != SILENT_AUDIO:
+        print(f"Feature extraction failed: {reason}")
+    return features
+
+
+# extracts several songs in one worker call, None for any that fail
+def get_features_batch(audio_files, duration=45, sr=22050, tier='full'):
+    return [get_features(audio_file, duration=duration, sr=sr, tier=tier) for audio_file in audio_files]
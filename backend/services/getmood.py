@@ -1,8 +1,16 @@
 import os
-import joblib
+import json
+import time
+import random
+import hashlib
+import threading
 import numpy as np
 from pydantic import BaseModel
 from constants.constants import EMOTION_COORDINATES
+from services.compiledtrees import CompiledEnsemble
+from services.emotionindex import EmotionIndex
+from services.metrics import span
+from services.getfeatures import FEATURE_TIERS, check_schema
 
 class EmotionResult(BaseModel):
     valence: float
@@ -15,50 +23,334 @@ class EmotionResult(BaseModel):
     percentage3: float
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-valence_model = joblib.load(os.path.join(BASE_DIR, 'model', 'valence_model.joblib'))
-arousal_model = joblib.load(os.path.join(BASE_DIR, 'model', 'arousal_model.joblib'))
-scaler = joblib.load(os.path.join(BASE_DIR, 'model', 'scaler.joblib'))
-COORDS = np.array(list(EMOTION_COORDINATES.values()))
-LABELS = np.array(list(EMOTION_COORDINATES.keys()))
+MODEL_DIR = os.path.join(BASE_DIR, 'model')
+# 'compiled' evaluates the tree tables from model/compile_model.py, 'sklearn' the joblib models
+MODEL_BACKEND = os.environ.get('MOOD_MODEL_BACKEND', 'compiled')
 
-def get_mood(features):
-    if features is None:
+# Model versions: 'default' is the artifacts in model/, any other version a directory of the
+# same files in model/versions/. Requests pick one with ?model=, or get one by MOOD_MODEL_SPLIT
+# weights, e.g. 'default:90,candidate:10'; unset sends everything to MOOD_MODEL_DEFAULT
+MODEL_VERSIONS_DIR = os.path.join(MODEL_DIR, 'versions')
+DEFAULT_VERSION = os.environ.get('MOOD_MODEL_DEFAULT', 'default')
+MODEL_SPLIT = os.environ.get('MOOD_MODEL_SPLIT', '')
+MODEL_WATCH_INTERVAL = float(os.environ.get('MOOD_MODEL_WATCH_INTERVAL', 5))  # seconds between checks, 0 turns watching off
+ARTIFACT_SUFFIXES = ('.joblib', '.npz')
+
+
+class ModelVersionError(ValueError):
+    pass
+
+
+# a feature tier the version has no trained models for
+class ModelTierError(ValueError):
+    pass
+
+
+# a pool worker couldn't load the files the server picked and has no older ones to fall back to
+class ModelLoadError(RuntimeError):
+    pass
+
+
+# full tier artifacts keep their original names, other tiers are prefixed, e.g. fast_scaler.joblib
+def model_path(filename, tier='full', model_dir=MODEL_DIR):
+    return os.path.join(model_dir, filename if tier == 'full' else f'{tier}_{filename}')
+
+
+def version_dir(version):
+    return MODEL_DIR if version == 'default' else os.path.join(MODEL_VERSIONS_DIR, version)
+
+
+# changes whenever one of a version's model artifacts is replaced; None once it has none
+def artifacts_fingerprint(model_dir):
+    try:
+        names = sorted(name for name in os.listdir(model_dir) if name.endswith(ARTIFACT_SUFFIXES))
+    except OSError:
         return None
+    digest = hashlib.sha256()
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(model_dir, name))
+        except OSError:
+            continue
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16] if names else None
+
+
+# the scaler and both regressors for one feature tier. Every artifact is checked against
+# the extractor's feature schema, so a mismatch fails at load instead of silently scaling
+# or predicting on the wrong columns
+class TierModels:
+    def __init__(self, tier='full', model_dir=MODEL_DIR):
+        self.tier = tier
+        sources = [model_path(name, tier, model_dir) for name in ('valence_model.joblib', 'arousal_model.joblib', 'scaler.joblib')]
+        compiled_path = model_path('mood_trees.npz', tier, model_dir)
+
+        # the compiled artifact carries the scaler too, so that path never imports sklearn
+        self.compiled = None
+        if MODEL_BACKEND == 'compiled' and os.path.exists(compiled_path):
+            self.compiled = CompiledEnsemble.load(compiled_path)
+            if not self.compiled.has_scaler or not self.compiled.matches(sources):
+                print(f"Compiled {tier} models are out of date, run model/compile_model.py. Using sklearn")
+                self.compiled = None
+            else:
+                check_schema(self.compiled, os.path.basename(compiled_path), tier)
+                self.feature_means = self.compiled.scaler_mean
+                self.feature_scales = self.compiled.scaler_scale
+        if self.compiled is None:
+            import joblib  # pulls in sklearn when unpickling, only needed on this path
+            self.valence_model, self.arousal_model, self.scaler = [joblib.load(source) for source in sources]
+            for artifact, source in zip((self.valence_model, self.arousal_model, self.scaler), sources):
+                check_schema(artifact, os.path.basename(source), tier)
+            self.feature_means = self.scaler.mean_
+            self.feature_scales = self.scaler.scale_
+
+    # raw 1-9 scale predictions for a (n, tier features) matrix, scaled once
+    def predict(self, features):
+        if self.compiled is not None:
+            return self.compiled.predict(self.compiled.scale(features)).T
+        features_scaled = self.scaler.transform(features)
+        return self.valence_model.predict(features_scaled), self.arousal_model.predict(features_scaled)
+
+
+# One model version: the TierModels of every tier it was trained for. Never changed once
+# built; a new version of the files is loaded into a new ModelSet that replaces this one,
+# so whoever still holds this one finishes with it
+class ModelSet:
+    def __init__(self, version, model_dir):
+        self.version = version
+        self.fingerprint = artifacts_fingerprint(model_dir)
+        if self.fingerprint is None:
+            raise ModelVersionError(f"Model version {version} has no artifacts in {model_dir}")
+        self.tiers = {'full': TierModels('full', model_dir)}
+        for tier in FEATURE_TIERS:
+            if tier == 'full':
+                continue
+            if os.path.exists(model_path('scaler.joblib', tier, model_dir)):
+                self.tiers[tier] = TierModels(tier, model_dir)
+            else:
+                print(f"No {tier} tier models for {version}, {tier} requests are refused until model/train_model.py trains them")
+        self.loaded_at = time.time()
+
+    # what responses report, the version and the exact artifacts that answered
+    @property
+    def label(self):
+        return f"{self.version}@{self.fingerprint}"
+
+    # a tier is only served by models trained on its features, never by the full model
+    # with the missing columns filled in
+    def require(self, tier):
+        if tier not in self.tiers:
+            raise ModelTierError(f"Model version {self.version} has no {tier} tier models, train them with model/train_model.py")
+
+    def predict(self, features, tier='full'):
+        self.require(tier)
+        return self.tiers[tier].predict(features)
+
+
+def parse_split(split):
+    weights = {}
+    for part in filter(None, (part.strip() for part in split.split(','))):
+        version, _, weight = part.partition(':')
+        weights[version.strip()] = float(weight or 1)
+    return weights
+
+
+# Every model version this process serves, loaded on first use. Artifacts are watched: a
+# version whose files changed, and then stayed unchanged for one more check (so a copy in
+# progress isn't loaded half done), is reloaded and swapped in. reload() swaps right away
+class ModelRegistry:
+    def __init__(self, default=DEFAULT_VERSION, split=MODEL_SPLIT, watch_interval=MODEL_WATCH_INTERVAL):
+        self.default = default
+        self.split = parse_split(split) or {default: 1.0}
+        self.watch_interval = watch_interval
+        self._sets = {}  # version -> ModelSet, the dict itself is replaced on every change
+        self._seen = {}  # version -> fingerprint seen by the last check
+        self._failed = {}  # version -> fingerprint that failed to load, not retried by the watcher
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
 
-    # Scale features using the same scaler from training
-    features_scaled = scaler.transform(features)
+    def versions(self):
+        found = ['default'] if artifacts_fingerprint(MODEL_DIR) else []
+        if os.path.isdir(MODEL_VERSIONS_DIR):
+            found += sorted(name for name in os.listdir(MODEL_VERSIONS_DIR)
+                            if not name.startswith('.') and artifacts_fingerprint(version_dir(name)))
+        return found
 
-    valence = valence_model.predict(features_scaled)[0]
-    arousal = arousal_model.predict(features_scaled)[0]
-    print(f"[DEBUG] Raw predictions - valence: {valence:.3f}, arousal: {arousal:.3f}")
+    def loaded(self):
+        return dict(self._sets)
+
+    def _swap(self, version):
+        loaded = ModelSet(version, version_dir(version))
+        self._sets = {**self._sets, version: loaded}
+        self._seen[version] = loaded.fingerprint
+        print(f"Loaded model version {loaded.label}")
+        return loaded
+
+    # the ModelSet of `version` (the default when None). With a fingerprint, as sent along
+    # by the server with a pool job, a process still holding older files than that loads
+    # the current ones first. That load has the server's guarantee: it is only tried while
+    # the files on disk are still the ones the server loaded, and if it fails the process
+    # keeps answering with what it has (ModelLoadError when it has nothing yet)
+    def get(self, version=None, fingerprint=None):
+        version = version or self.default
+        self._watch()
+        loaded = self._sets.get(version)
+        if loaded is not None and (fingerprint is None or loaded.fingerprint == fingerprint):
+            return loaded
+        with self._lock:
+            loaded = self._sets.get(version)
+            current = artifacts_fingerprint(version_dir(version))
+            if loaded is not None and (current == loaded.fingerprint or (fingerprint is not None and current != fingerprint)):
+                return loaded
+            try:
+                return self._swap(version)
+            except Exception as e:
+                if fingerprint is None:
+                    raise
+                if loaded is None:
+                    raise ModelLoadError(f"Model version {version} failed to load ({type(e).__name__}: {e})") from e
+                print(f"Loading model version {version} failed ({type(e).__name__}: {e}), keeping {loaded.label}")
+                return loaded
+
+    # `requested` if it names a version, otherwise one drawn by the split weights; with a
+    # key (e.g. the audio hash) the same key always gets the same version
+    def choose(self, requested=None, key=None):
+        if requested is not None:
+            if requested not in self._sets and requested not in self.versions():
+                raise ModelVersionError(f"Unknown model version {requested}")
+            return requested
+        versions = list(self.split)
+        weights = np.array([self.split[version] for version in versions])
+        point = int(key[:8], 16) / 16 ** 8 if key else random.random()
+        index = np.searchsorted(np.cumsum(weights) / weights.sum(), point, side='right')
+        return versions[min(int(index), len(versions) - 1)]
+
+    def set_split(self, split):
+        available = self.versions()
+        unknown = [version for version in split if version not in available]
+        if unknown:
+            raise ModelVersionError(f"Unknown model versions {', '.join(unknown)}")
+        if not split or sum(split.values()) <= 0 or min(split.values()) < 0:
+            raise ModelVersionError("The split needs non-negative weights that add up to more than 0")
+        self.split = dict(split)
+
+    # reloads every loaded version whose files changed; a version that fails to load keeps
+    # its previous ModelSet. Returns {version: error} for the failures
+    def reload(self, stable_only=False):
+        errors = {}
+        with self._lock:
+            for version, loaded in self._sets.items():
+                fingerprint = artifacts_fingerprint(version_dir(version))
+                previous = self._seen.get(version)
+                self._seen[version] = fingerprint
+                if fingerprint == loaded.fingerprint or fingerprint is None:
+                    continue
+                if stable_only and (fingerprint != previous or fingerprint == self._failed.get(version)):
+                    continue
+                try:
+                    self._swap(version)
+                    self._failed.pop(version, None)
+                except Exception as e:
+                    print(f"Reloading model version {version} failed ({type(e).__name__}: {e}), keeping {loaded.label}")
+                    self._failed[version] = fingerprint
+                    errors[version] = f"{type(e).__name__}: {e}"
+        return errors
+
+    def _watch(self):
+        if self.watch_interval <= 0 or time.monotonic() - self._checked < self.watch_interval:
+            return
+        self._checked = time.monotonic()
+        self.reload(stable_only=True)
+
+
+registry = ModelRegistry()
+
+
+# loads the default version and every version in the split, on first use or up front from
+# the server's startup; returns the default's models per tier
+def load_models():
+    for version in registry.split:
+        registry.get(version)
+    return registry.get().tiers
+
+
+# Emotion coordinates: constants/constants.py, or EMOTION_COORDINATES_FILE, a JSON object of
+# {"name": [valence, arousal]} that is re-read whenever it changes, so a custom set takes
+# effect in every process without a restart
+EMOTION_COORDINATES_FILE = os.environ.get('EMOTION_COORDINATES_FILE')
+
+_emotions = EmotionIndex(EMOTION_COORDINATES)
+_emotions_mtime = None
+_emotions_lock = threading.Lock()
+
+
+# swaps in a new coordinate set; the index is built before the swap, so a lookup never
+# sees a half-built one
+def set_emotion_coordinates(coordinates):
+    global _emotions
+    _emotions = EmotionIndex(coordinates)
+
+
+def emotion_index():
+    if EMOTION_COORDINATES_FILE:
+        try:
+            mtime = os.stat(EMOTION_COORDINATES_FILE).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != _emotions_mtime:
+            with _emotions_lock:
+                if mtime != _emotions_mtime:
+                    _load_emotion_file(mtime)
+    return _emotions
+
+
+def _load_emotion_file(mtime):
+    global _emotions_mtime
+    _emotions_mtime = mtime
+    if mtime is None:
+        print(f"{EMOTION_COORDINATES_FILE} not found, keeping the current emotion coordinates")
+        return
+    try:
+        with open(EMOTION_COORDINATES_FILE) as f:
+            set_emotion_coordinates({name: tuple(point) for name, point in json.load(f).items()})
+        print(f"Loaded {len(_emotions.labels)} emotion coordinates from {EMOTION_COORDINATES_FILE}")
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Invalid {EMOTION_COORDINATES_FILE} ({e}), keeping the current emotion coordinates")
+
+
+# ranks the 3 nearest emotions for each (valence, arousal) row, for any number of rows at
+# once; returns labels and percentages, both (n, 3)
+def rank_emotions(points, index=None):
+    return (index or emotion_index()).rank(points)
+
+
+# runs each regressor once over a (n, features) matrix extracted with the given tier, with
+# `models` (a ModelSet) or the default version
+def get_moods(features, tier='full', models=None):
+    models = models or registry.get()
+    with span('predict'):
+        valence, arousal = models.predict(features, tier)
 
     # DEAM dataset uses 1-9 scale, normalize to 0-1
-    v = (valence - 1) / 8
-    a = (arousal - 1) / 8
-    print(f"[DEBUG] Normalized - v: {v:.3f}, a: {a:.3f}")
-    v = max(0.0, min(1.0, v))
-    a = max(0.0, min(1.0, a))
-
-    # Vector Distance Calculation
-    input_point = np.array([v, a])
-    distances = np.linalg.norm(COORDS - input_point, axis=1)
-    
-    #Top3 Emotions
-    top_3_idx = np.argsort(distances)[:3]
-
-    #Calculate percentages
-    top_3_dists = distances[top_3_idx]
-    weights = 1 / (1 + top_3_dists)
-    percentages = (weights / np.sum(weights)) * 100
-
-    top_3_labels = LABELS[top_3_idx]
-    return EmotionResult(
-        valence=v,
-        arousal=a,
-        emotion1=top_3_labels[0], percentage1=round(percentages[0], 2),
-        emotion2=top_3_labels[1], percentage2=round(percentages[1], 2),
-        emotion3=top_3_labels[2], percentage3=round(percentages[2], 2)
-    )
+    v = np.clip((valence - 1) / 8, 0.0, 1.0)
+    a = np.clip((arousal - 1) / 8, 0.0, 1.0)
 
+    with span('rank'):
+        labels, percentages = rank_emotions(np.column_stack([v, a]))
+    return [
+        EmotionResult(
+            valence=v[i],
+            arousal=a[i],
+            emotion1=labels[i, 0], percentage1=round(percentages[i, 0], 2),
+            emotion2=labels[i, 1], percentage2=round(percentages[i, 1], 2),
+            emotion3=labels[i, 2], percentage3=round(percentages[i, 2], 2)
+        )
+        for i in range(len(features))
+    ]
 
 
+def get_mood(features, tier='full', models=None):
+    if features is None:
+        return None
+
+    return get_moods(features, tier, models)[0]
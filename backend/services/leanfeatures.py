@@ -0,0 +1,247 @@
+import threading
+import librosa
+import numba
+import scipy.ndimage
+import scipy.signal
+import numpy as np
+from services.getfeatures import FEATURE_GROUPS, FEATURE_TIERS, HOP_LENGTH, N_FFT, tier_feature_names
+from services.metrics import span
+
+# EXTRACTION_MODE=lean: the features of getfeatures.extract_features in float32, into scratch
+# buffers reused across requests. Kept apart so the default mode never imports numba or scipy
+LEAN_DTYPE = np.dtype(np.float32)
+LEAN_BLOCK_FRAMES = 256  # frames per block for the lean tuning and tempo estimates
+LEAN_BLOCK_BINS = 128  # frequency bins median-filtered together by the lean HPSS
+
+
+# Grow-only scratch arrays reused from one request to the next, so the lean path allocates its
+# spectrogram-sized buffers once per worker instead of on every call. take() returns a view of
+# the named buffer with whatever the last user left in it; a name is only ever used by one
+# step at a time. One arena per thread (a pool worker runs one extraction at a time)
+class BufferArena:
+    def __init__(self):
+        self.buffers = {}
+
+    def take(self, name, shape, dtype=LEAN_DTYPE):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = self.buffers[name] = np.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+
+_arenas = threading.local()
+
+
+def buffer_arena():
+    if not hasattr(_arenas, 'arena'):
+        _arenas.arena = BufferArena()
+    return _arenas.arena
+
+
+# writes the means of every row of `x` to out[:k] and their population stds to out[k:2k],
+# in one pass with float64 accumulators (Welford), whatever the dtype of `x` and `out`
+@numba.njit(cache=True)
+def _mean_std_into(x, out):
+    rows, n = x.shape
+    for i in range(rows):
+        mean = 0.0
+        m2 = 0.0
+        for j in range(n):
+            value = float(x[i, j])
+            delta = value - mean
+            mean += delta / (j + 1)
+            m2 += delta * (value - mean)
+        out[i] = mean
+        out[rows + i] = np.sqrt(m2 / n)
+
+
+# zero_crossing_rate(y) from a running count of sign changes; samples within 1e-10 of zero
+# count as positive, and the edge padding librosa frames with adds no crossings
+def _zcr_lean(y, arena):
+    negative = arena.take('zcr.negative', len(y), np.bool_)
+    np.less(y, -1e-10, out=negative)
+    changes = arena.take('zcr.changes', len(y) - 1, np.bool_)
+    np.not_equal(negative[1:], negative[:-1], out=changes)
+    crossings = arena.take('zcr.crossings', len(y), np.int32)
+    crossings[0] = 0
+    np.cumsum(changes, dtype=np.int32, out=crossings[1:])  # crossings[i]: changes up to sample i
+
+    starts = np.arange(1 + len(y) // HOP_LENGTH) * HOP_LENGTH - N_FFT // 2
+    lo = np.clip(starts, 0, len(y) - 1)
+    hi = np.clip(starts + N_FFT - 1, 0, len(y) - 1)
+    return ((crossings[hi] - crossings[lo]) / LEAN_DTYPE.type(N_FFT)).astype(LEAN_DTYPE)
+
+
+# rms(y): float32 sums of squares over zero-padded frames, a strided view, no frame copies
+def _rms_lean(y, arena):
+    pad = N_FFT // 2
+    padded = arena.take('rms.padded', len(y) + 2 * pad)
+    padded[:pad] = 0
+    padded[pad:pad + len(y)] = y
+    padded[pad + len(y):] = 0
+    framed = librosa.util.frame(padded, frame_length=N_FFT, hop_length=HOP_LENGTH)
+    power = np.einsum('ij,ij->j', framed, framed)
+    return np.sqrt(power / LEAN_DTYPE.type(N_FFT), out=power)
+
+
+# centroid, bandwidth and rolloff of magnitudes S. The frequency moments behind centroid and
+# bandwidth come from one (3, bins) x (bins, frames) product instead of three weighted copies of S
+def _spectral_lean(S, sr, scratch):
+    freq = librosa.fft_frequencies(sr=sr, n_fft=N_FFT).astype(LEAN_DTYPE)
+    moments = np.stack([np.ones_like(freq), freq, freq * freq]) @ S
+    total = np.where(moments[0] < np.finfo(LEAN_DTYPE).tiny, 1, moments[0])  # silent frames stay unnormalized, as in librosa
+    centroid = moments[1] / total
+    bandwidth = np.sqrt(np.maximum(moments[2] / total - centroid * centroid * (2 - moments[0] / total), 0))
+
+    # rolloff: the lowest bin whose cumulative energy reaches 85% of the frame's
+    np.cumsum(S, axis=0, out=scratch)
+    rolloff = freq[np.argmax(scratch >= 0.85 * scratch[-1], axis=0)]
+    return [centroid[np.newaxis, :], bandwidth[np.newaxis, :], rolloff[np.newaxis, :]]
+
+
+# the peaks librosa.estimate_tuning(S=S) measures: piptrack thresholds every frame against its
+# own maximum, so it runs on blocks of frames and only the detected (pitch, magnitude) pairs
+# are kept, instead of the several spectrogram-sized arrays it builds at once
+def _pitch_peaks(S, sr):
+    pitches, magnitudes = [], []
+    for start in range(0, S.shape[1], LEAN_BLOCK_FRAMES):
+        pitch, mag = librosa.piptrack(S=S[:, start:start + LEAN_BLOCK_FRAMES], sr=sr, n_fft=N_FFT)
+        found = pitch > 0
+        pitches.append(pitch[found])
+        magnitudes.append(mag[found])
+    return np.concatenate(pitches), np.concatenate(magnitudes)
+
+
+def _tuning(peaks, bins_per_octave):
+    pitches, magnitudes = peaks
+    threshold = np.median(magnitudes) if len(magnitudes) else 0.0
+    return librosa.pitch_tuning(pitches[magnitudes >= threshold], bins_per_octave=bins_per_octave)
+
+
+# _tempo(onset_env, sr) with the tempogram averaged over blocks of frames instead of built
+# whole; librosa.feature.tempo only uses its mean over time
+def _tempo_lean(onset_env, sr):
+    if not onset_env.any():
+        return np.zeros(1)
+    win_length = librosa.time_to_frames(8.0, sr=sr, hop_length=HOP_LENGTH).item()
+    padded = np.pad(onset_env, win_length // 2, mode='linear_ramp', end_values=[0, 0])
+    frames = librosa.util.frame(padded, frame_length=win_length, hop_length=1)[:, :len(onset_env)]
+    window = scipy.signal.get_window('hann', win_length, fftbins=True)[:, np.newaxis]
+    total = np.zeros(win_length)
+    for start in range(0, frames.shape[1], LEAN_BLOCK_FRAMES):
+        block = frames[:, start:start + LEAN_BLOCK_FRAMES] * window
+        total += librosa.util.normalize(librosa.autocorrelate(block, axis=0), norm=np.inf, axis=0).sum(axis=1)
+    tg = (total / len(onset_env))[:, np.newaxis]
+    return np.atleast_1d(librosa.feature.tempo(tg=tg, sr=sr, hop_length=HOP_LENGTH))[:1]
+
+
+# mean |harmonic| and mean |percussive| of y, as hpss(stft) and istft compute them. The median
+# filters and soft masks run over bands of frequency bins (the percussive filter reads
+# kernel // 2 bins past each edge, so every band matches the whole-spectrogram result), and
+# both signals are resynthesized into the same reused buffers one after the other
+def _harmonic_percussive_lean(stft, S, n, arena, kernel=31):
+    masked = arena.take('hpss.masked', stft.shape, stft.dtype)
+    percussive_mask = arena.take('scratch', S.shape)
+    halo = kernel // 2
+    for start in range(0, S.shape[0], LEAN_BLOCK_BINS):
+        stop = min(start + LEAN_BLOCK_BINS, S.shape[0])
+        lo, hi = max(start - halo, 0), min(stop + halo, S.shape[0])
+        harm = scipy.ndimage.median_filter(S[start:stop], size=(1, kernel), mode='reflect')
+        perc = scipy.ndimage.median_filter(S[lo:hi], size=(kernel, 1), mode='reflect')[start - lo:stop - lo]
+        np.multiply(stft[start:stop], librosa.util.softmask(harm, perc, power=2, split_zeros=True), out=masked[start:stop])
+        percussive_mask[start:stop] = librosa.util.softmask(perc, harm, power=2, split_zeros=True)
+
+    signal = arena.take('hpss.signal', n)
+    librosa.istft(masked, hop_length=HOP_LENGTH, length=n, out=signal)
+    harmonic = np.sum(np.abs(signal, out=signal)) / n
+    np.multiply(stft, percussive_mask, out=masked)
+    librosa.istft(masked, hop_length=HOP_LENGTH, length=n, out=signal)
+    percussive = np.sum(np.abs(signal, out=signal)) / n
+    return harmonic, percussive
+
+
+# extract_features in float32: the STFT, magnitudes, power and mel spectrogram live in arena
+# buffers, every feature family writes its slice of one preallocated (1, features) row, and
+# the spectrogram-sized temporaries librosa would create (float64 frequency weighting,
+# piptrack, the tempogram, full harmonic/percussive spectrograms and signals) are avoided or
+# cut into blocks. Tonnetz still runs librosa's constant-Q transform, given the tuning
+# measured on the shared STFT instead of a second STFT of its own
+def extract_features_lean(y, sr=22050, tier='full', out=None):
+    wanted = FEATURE_TIERS[tier]
+    if out is None:
+        out = np.empty((1, len(tier_feature_names(tier))), dtype=LEAN_DTYPE)
+    row = out[0]
+    offsets = {}
+    position = 0
+    for group in wanted:
+        offsets[group] = position
+        position += len(FEATURE_GROUPS[group])
+
+    def write(group, parts):
+        position = offsets[group]
+        for part in parts:
+            _mean_std_into(part, row[position:position + 2 * len(part)])
+            position += 2 * len(part)
+
+    arena = buffer_arena()
+    y = np.asarray(y, dtype=LEAN_DTYPE)
+    n_frames = 1 + len(y) // HOP_LENGTH
+    bins = 1 + N_FFT // 2
+
+    # Shared intermediates
+    with span('feature.stft'):
+        stft = librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH, out=arena.take('stft', (bins, n_frames), np.complex64))
+        S = np.abs(stft, out=arena.take('magnitude', stft.shape))
+        S_power = np.square(S, out=arena.take('scratch', S.shape))
+    with span('feature.mel'):
+        mel_db = np.dot(_mel_basis(sr), S_power, out=arena.take('mel', (128, n_frames)))
+        # power_to_db in place: 10 log10(max(x, 1e-10)), clipped to 80 dB below the peak
+        np.maximum(mel_db, 1e-10, out=mel_db)
+        np.log10(mel_db, out=mel_db)
+        mel_db *= 10
+        np.maximum(mel_db, mel_db.max() - 80, out=mel_db)
+
+    # Tonal features first, while the power spectrogram is still in 'scratch'
+    with span('feature.chroma'):
+        chroma_basis = librosa.filters.chroma(sr=sr, n_fft=N_FFT, tuning=_tuning(_pitch_peaks(S_power, sr), 12))
+        write('chroma', [librosa.util.normalize(chroma_basis @ S_power, norm=np.inf, axis=0)])
+
+    if 'tonnetz' in wanted:
+        with span('feature.tonnetz'):
+            write('tonnetz', [librosa.feature.tonnetz(y=y, sr=sr, tuning=_tuning(_pitch_peaks(S, sr), 36))])
+
+    with span('feature.temporal'):
+        write('temporal', [_zcr_lean(y, arena)[np.newaxis, :], _rms_lean(y, arena)[np.newaxis, :]])
+
+    with span('feature.spectral'):
+        write('spectral', _spectral_lean(S, sr, arena.take('scratch', S.shape)) + [librosa.feature.spectral_contrast(S=S, sr=sr)])
+
+    with span('feature.rhythm'):
+        onset_env = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=HOP_LENGTH, aggregate=np.median)
+        row[offsets['rhythm']] = _tempo_lean(onset_env, sr)[0]
+
+    with span('feature.timbre'):
+        write('timbre', [librosa.feature.mfcc(S=mel_db, n_mfcc=13)])
+
+    if 'harmonic_percussive' in wanted:
+        with span('feature.harmonic_percussive'):
+            harmonic, percussive = _harmonic_percussive_lean(stft, S, len(y), arena)
+            mean_abs = np.sum(np.abs(y, out=arena.take('hpss.signal', len(y)))) / len(y) + LEAN_DTYPE.type(1e-6)
+            row[offsets['harmonic_percussive']:offsets['harmonic_percussive'] + 2] = (harmonic / mean_abs, percussive / mean_abs)
+
+    return out
+
+
+_mel_bases = {}
+
+
+def _mel_basis(sr):
+    if sr not in _mel_bases:
+        _mel_bases[sr] = librosa.filters.mel(sr=sr, n_fft=N_FFT)
+    return _mel_bases[sr]
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Metrics settings, overridable per deployment
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'  # one JSON line per request on stdout
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# the stage timings and log fields of one request, or of one job inside a pool worker
+class Trace:
+    def __init__(self):
+        self.spans = []  # (stage, seconds) in the order they finished
+        self.fields = {}
+
+
+_trace = ContextVar('trace', default=None)
+
+
+def start_trace():
+    trace = Trace()
+    _trace.set(trace)
+    return trace
+
+
+# times a block as one stage of the current trace; a no-op outside of one
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _trace.get()
+        if trace is not None:
+            trace.spans.append((stage, time.perf_counter() - start))
+
+
+# adds fields to the current request's log line, e.g. the cache outcome
+def annotate(**fields):
+    trace = _trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+# adds spans recorded elsewhere (in a pool worker) to the current trace
+def add_spans(spans):
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.extend(spans)
+
+
+# runs in a pool worker: collects that job's spans so they travel back with its result
+def run_traced(fn, *args):
+    trace = start_trace()
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, trace.spans, time.perf_counter() - start
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.setdefault(label_values, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_labels(self.labels, label_values, le=bound)} {count}')
+                lines.append(f'{self.name}_bucket{_labels(self.labels, label_values, le="+Inf")} {series[-1]}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, label_values)} {series[-2]}')
+                lines.append(f'{self.name}_count{_labels(self.labels, label_values)} {series[-1]}')
+        return lines
+
+
+# a value read when /metrics is scraped, e.g. the pool's queue depth
+class Gauge:
+    def __init__(self, name, help, read, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', f'{self.name} {self.read()}']
+
+
+REQUEST_SECONDS = Histogram('mood_request_seconds', 'Request latency by route and status', ('route', 'status'))
+STAGE_SECONDS = Histogram('mood_stage_seconds', 'Time spent per analysis stage', ('stage',))
+_registry = [REQUEST_SECONDS, STAGE_SECONDS]
+
+
+def gauge(name, help, read, kind='gauge'):
+    _registry.append(Gauge(name, help, read, kind))
+
+
+# records a finished request into the histograms and logs it as one JSON line
+def finish_request(trace, method, route, status, seconds):
+    REQUEST_SECONDS.observe(seconds, route, status)
+    stages = {}
+    for stage, elapsed in trace.spans:
+        STAGE_SECONDS.observe(elapsed, stage)
+        stages[stage] = stages.get(stage, 0.0) + elapsed
+
+    if REQUEST_LOG:
+        print(json.dumps({
+            'event': 'request',
+            'method': method,
+            'route': route,
+            'status': status,
+            'ms': round(seconds * 1000, 1),
+            'stages_ms': {stage: round(elapsed * 1000, 1) for stage, elapsed in stages.items()},
+            **trace.fields,
+        }), flush=True)
+
+
+# Prometheus text exposition format
+def render():
+    return '\n'.join(line for metric in _registry for line in metric.render()) + '\n'
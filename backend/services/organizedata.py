@@ -8,8 +8,9 @@ class Emotion(BaseModel):
     emoji: str
     description: str
 
+# emotions from a custom coordinate set may have no emoji or description
 def organize_data(name: str, percentage: float) -> Emotion:
-    data = json.loads(text[name])
+    data = json.loads(text[name]) if name in text else {"emoji": "", "description": ""}
     return Emotion(
         name=name,
         percentage=percentage,
@@ -0,0 +1,182 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from services.metrics import add_spans, run_traced
+
+# Pool settings, overridable per deployment
+WORKERS = int(os.environ.get('ANALYSIS_WORKERS', os.cpu_count() or 1))
+QUEUE_SIZE = int(os.environ.get('ANALYSIS_QUEUE_SIZE', 2 * WORKERS))
+TIMEOUT = float(os.environ.get('ANALYSIS_TIMEOUT', 60))
+RETRY_AFTER = int(os.environ.get('ANALYSIS_RETRY_AFTER', 5))
+WARM_UP = os.environ.get('ANALYSIS_WARM_UP', '1') != '0'  # run the extractor once per worker at start
+SMOOTHING = 0.2  # weight of the latest job in the running job-time averages
+
+
+class PoolFull(Exception):
+    pass
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# runs once in every worker so the first request doesn't pay for model and image loading
+# or for numba compiling librosa's kernels
+def _warm_worker():
+    from services import getfeatures, getmood, visualization
+    getmood.load_models()
+    visualization.load_base_graph()
+    if WARM_UP:
+        getfeatures.warm_up()
+
+
+def _noop():
+    return None
+
+
+class _Job:
+    def __init__(self, fn, args, cost, turn):
+        self.fn = fn
+        self.args = args
+        self.cost = cost  # estimated seconds, None if the caller had no estimate
+        self.turn = turn  # resolves to the executor future once a worker is free, None until run()
+        self.started = None
+
+
+# Jobs wait here rather than in the executor's FIFO queue and are handed to a worker as
+# one frees up, cheapest first: each is ordered by its arrival time plus its estimated
+# cost, so a 0.5 s job overtakes a 4 s one that arrived less than 3.5 s before it, and
+# nothing waits behind newer jobs forever. Estimates are corrected by `scale`, the running
+# ratio of measured to estimated job time
+class AnalysisPool:
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, timeout=TIMEOUT):
+        self.workers = workers
+        self.capacity = workers + queue_size  # running + waiting jobs
+        self.timeout = timeout
+        self.pending = 0
+        self.running = 0
+        self.scale = 1.0
+        self.job_seconds = 1.0  # running average of job time, stands in for jobs without an estimate
+        self._executor = None
+        self._warming = []
+        self._waiting = []  # heap of (arrival + cost, order, job)
+        self._jobs = set()  # waiting and running
+        self._order = itertools.count()
+
+    def start(self):
+        # spawn rather than fork: the server process already runs threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_worker,
+        )
+        # workers start on demand, so submit one no-op each to bring them all up now
+        self._warming = [self._executor.submit(_noop) for _ in range(self.workers)]
+
+    # True once the warm-up no-ops have run, i.e. the workers finished their initializer
+    @property
+    def ready(self):
+        return self._executor is not None and all(job.done() for job in self._warming)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _estimate(self, job):
+        return job.cost * self.scale if job.cost is not None else self.job_seconds
+
+    # estimated seconds of work queued and running per worker, what a new job waits at most
+    @property
+    def backlog(self):
+        now = time.perf_counter()
+        work = sum(
+            max(self._estimate(job) - (now - job.started if job.started is not None else 0.0), 0.0)
+            for job in self._jobs
+        )
+        return work / self.workers
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._executor is not None and self.running < self.workers and self._waiting:
+            _, _, job = heapq.heappop(self._waiting)
+            if job.turn.cancelled():
+                continue  # timed out while waiting, already released
+            # the worker times its own stages and sends them back with the result
+            future = self._executor.submit(run_traced, job.fn, *job.args)
+            self.running += 1
+            job.started = time.perf_counter()
+            # the slot is only freed once the worker is really done, even after a timeout
+            future.add_done_callback(lambda _, job=job: self._schedule_finish(loop, job))
+            job.turn.set_result(future)
+
+    # runs in the executor's thread; after shutdown the server's loop may already be closed,
+    # and cancelled or finishing jobs have nothing left to free
+    def _schedule_finish(self, loop, job):
+        if loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._finish, job)
+        except RuntimeError:
+            pass  # closed between the check and the call
+
+    def _finish(self, job):
+        self.running -= 1
+        self._release(job)
+        self._dispatch()
+
+    def _release(self, job):
+        self.pending -= 1
+        self._jobs.discard(job)
+
+    def _observe(self, job, elapsed):
+        if job.cost:
+            self.scale += SMOOTHING * (min(max(elapsed / job.cost, 0.1), 10.0) - self.scale)
+        self.job_seconds += SMOOTHING * (elapsed - self.job_seconds)
+
+    # counts a job in the backlog from the moment it's admitted, before it reaches run(),
+    # so requests arriving together see each other; hand it to run() as `job`, or
+    # discard() it if it never gets there
+    def reserve(self, cost):
+        job = _Job(None, (), cost, None)
+        self._jobs.add(job)
+        return job
+
+    def discard(self, job):
+        if job.turn is None:
+            self._jobs.discard(job)
+
+    # `cost` is the job's estimated seconds (services.admission), it orders the queue
+    async def run(self, fn, *args, cost=None, job=None, timeout=None):
+        if self.pending >= self.capacity:
+            raise PoolFull()
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        if job is None:
+            job = _Job(fn, args, cost, None)
+        job.fn, job.args, job.turn = fn, args, loop.create_future()
+        self.pending += 1
+        self._jobs.add(job)
+        heapq.heappush(self._waiting, (start + self._estimate(job), next(self._order), job))
+        self._dispatch()
+
+        try:
+            # on timeout the job is dropped if it's still waiting for a worker
+            async with asyncio.timeout(timeout or self.timeout):
+                future = await job.turn
+                result, spans, elapsed = await asyncio.wrap_future(future)
+        except TimeoutError:
+            raise PoolTimeout()
+        finally:
+            if job.turn.cancelled():
+                self._release(job)
+
+        self._observe(job, elapsed)
+        # whatever the worker didn't spend running the job was queueing and pickling
+        add_spans([('pool.queue', time.perf_counter() - start - elapsed)] + spans)
+        return result
@@ -0,0 +1,184 @@
+import os
+import numpy as np
+import librosa
+import soxr
+from services.getfeatures import FEATURE_DTYPE, FEATURE_TIERS, HOP_LENGTH, N_FFT, _tempo, decode_audio
+
+# Streaming settings, overridable per deployment
+STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS', 16))
+STREAM_MAX_CHUNK_BYTES = int(os.environ.get('STREAM_MAX_CHUNK_BYTES', 1024 * 1024))
+STREAM_MAX_CHUNK_SECONDS = 60  # decoded from one encoded message at most, compressed chunks can expand a lot
+STREAM_QUEUE_CHUNKS = int(os.environ.get('STREAM_QUEUE_CHUNKS', 8))  # received chunks waiting for analysis
+STREAM_SEND_TIMEOUT = float(os.environ.get('STREAM_SEND_TIMEOUT', 10))  # a client that reads slower is dropped
+STREAM_HALFLIFE = 30  # seconds until a frame counts half as much as the newest one, 0 keeps everything
+STREAM_INTERVAL = 5  # seconds of audio between updates
+TEMPO_SECONDS = 45  # tempo is estimated over this much of the latest onset envelope
+
+# Tonnetz and HPSS need the whole clip at once; every feature of the fast tier is frame-wise
+STREAM_TIER = 'fast'
+
+
+# Exponentially weighted count, mean and sum of squared deviations per row, merged one block
+# of frames at a time (Chan's parallel update with weights), so nothing is ever recomputed.
+# With decay 1 it is the plain running mean and population std of every frame so far
+class RunningMoments:
+    def __init__(self, rows, decay=1.0):
+        self.decay = decay
+        self.weight = 0.0
+        self.mean = np.zeros(rows)
+        self.m2 = np.zeros(rows)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        n = x.shape[1]
+        w = self.decay ** np.arange(n - 1, -1, -1)
+        block_weight = w.sum()
+        block_mean = x @ w / block_weight
+        block_m2 = (x - block_mean[:, np.newaxis]) ** 2 @ w
+
+        old_weight = self.weight * self.decay ** n
+        self.weight = old_weight + block_weight
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta * block_weight / self.weight
+        self.m2 = self.m2 * self.decay ** n + block_m2 + delta ** 2 * old_weight * block_weight / self.weight
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(self.m2 / self.weight, 0.0))
+
+
+# raw interleaved PCM messages to mono float32; a sample split across two messages is kept
+class PcmDecoder:
+    def __init__(self, encoding='f32', channels=1):
+        self.dtype = np.dtype('<f4') if encoding == 'f32' else np.dtype('<i2')
+        self.frame_bytes = self.dtype.itemsize * channels
+        self.channels = channels
+        self.pending = b''
+
+    def decode(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % self.frame_bytes
+        self.pending = data[usable:]
+        y = np.frombuffer(data[:usable], dtype=self.dtype).reshape(-1, self.channels)
+        y = y.mean(axis=1) if self.channels > 1 else y[:, 0]
+        if self.dtype.kind == 'i':
+            y = y / 32768.0
+        return y.astype(np.float32), None
+
+
+# every message is a complete file of its own (e.g. a short WAV, FLAC or OGG segment)
+class EncodedDecoder:
+    def decode(self, data):
+        try:
+            return decode_audio(data, duration=STREAM_MAX_CHUNK_SECONDS)
+        except Exception as e:
+            raise ValueError(f"Unable to decode audio chunk: {e}")
+
+
+# Fast-tier features of a live stream, updated as audio arrives. Frames are cut from a
+# tail buffer as soon as N_FFT samples are available (no centering), their per-frame values
+# are folded into RunningMoments and dropped, so a connection holds a fixed amount of state
+# however long it runs: under N_FFT samples, one mel frame, TEMPO_SECONDS of onset envelope
+class StreamAnalyzer:
+    def __init__(self, decoder, halflife=STREAM_HALFLIFE, sr=22050):
+        self.decoder = decoder
+        self.sr = sr
+        self.decay = 0.5 ** (HOP_LENGTH / (halflife * sr)) if halflife > 0 else 1.0
+        self.input_sr = None
+        self.resampler = None
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.moments = None
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=N_FFT)  # built once, not on every block
+        self.chroma_basis = None
+        self.previous_mel = None
+        self.onsets = np.zeros(0)
+        self.max_onsets = int(TEMPO_SECONDS * sr / HOP_LENGTH)
+        self.seconds = 0.0  # audio received so far
+        self.peak = 0.0  # loudest sample since the last update
+
+    # decodes one message, at `input_sr` for raw PCM; raises ValueError on bad audio
+    def push(self, data, input_sr=None):
+        y, file_sr = self.decoder.decode(data)
+        file_sr = file_sr or input_sr
+        if self.input_sr is None:
+            self.input_sr = file_sr
+            if file_sr != self.sr:
+                self.resampler = soxr.ResampleStream(file_sr, self.sr, 1, dtype='float32')
+        elif file_sr != self.input_sr:
+            raise ValueError(f"sample rate changed from {self.input_sr} to {file_sr} Hz mid-stream")
+
+        self.seconds += len(y) / file_sr
+        if len(y):
+            self.peak = max(self.peak, float(np.max(np.abs(y))))
+        if self.resampler is not None:
+            y = self.resampler.resample_chunk(y)
+        self.buffer = np.concatenate([self.buffer, y])
+        self._analyze()
+
+    def _analyze(self):
+        n_frames = 1 + (len(self.buffer) - N_FFT) // HOP_LENGTH
+        if n_frames < 1:
+            return
+        y = self.buffer[:N_FFT + (n_frames - 1) * HOP_LENGTH]
+        self.buffer = self.buffer[n_frames * HOP_LENGTH:]
+
+        S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH, center=False))
+        S_power = S ** 2
+        # top_db clipping is relative to each block's loudest bin here, not the whole clip's
+        mel_db = librosa.power_to_db(self.mel_basis @ S_power)
+        if self.chroma_basis is None:
+            # tuning is estimated once, from the first block, so chroma bins don't shift between updates
+            tuning = librosa.estimate_tuning(S=S_power, sr=self.sr, bins_per_octave=12)
+            self.chroma_basis = librosa.filters.chroma(sr=self.sr, n_fft=N_FFT, tuning=tuning)
+
+        framed = librosa.util.frame(y, frame_length=N_FFT, hop_length=HOP_LENGTH)
+        centroid = librosa.feature.spectral_centroid(S=S, sr=self.sr)
+        parts = {
+            'temporal': [
+                librosa.feature.zero_crossing_rate(y, frame_length=N_FFT, hop_length=HOP_LENGTH, center=False),
+                np.sqrt(np.mean(np.square(framed, dtype=np.float64), axis=0))[np.newaxis, :],
+            ],
+            'spectral': [
+                centroid,
+                librosa.feature.spectral_bandwidth(S=S, sr=self.sr, centroid=centroid),
+                librosa.feature.spectral_rolloff(S=S, sr=self.sr),
+                librosa.feature.spectral_contrast(S=S, sr=self.sr),
+            ],
+            'chroma': [librosa.util.normalize(self.chroma_basis @ S_power, norm=np.inf, axis=0)],
+            'timbre': [librosa.feature.mfcc(S=mel_db, n_mfcc=13)],
+        }
+
+        if self.moments is None:
+            self.moments = {
+                group: [RunningMoments(len(part), self.decay) for part in group_parts]
+                for group, group_parts in parts.items()
+            }
+        for group, group_parts in parts.items():
+            for moments, part in zip(self.moments[group], group_parts):
+                moments.update(part)
+
+        # onset strength as librosa.onset.onset_strength(S=mel_db, aggregate=np.median) computes
+        # it, carrying the previous block's last mel frame across the boundary
+        previous = self.previous_mel if self.previous_mel is not None else mel_db[:, :1]
+        flux = np.maximum(0.0, np.diff(np.concatenate([previous, mel_db], axis=1), axis=1))
+        self.onsets = np.concatenate([self.onsets, np.median(flux, axis=0)])[-self.max_onsets:]
+        self.previous_mel = mel_db[:, -1:]
+
+    # (1, features) in the stream tier's schema order, None until the first frame is in
+    def features(self):
+        if self.moments is None:
+            return None
+        values = []
+        for group in FEATURE_TIERS[STREAM_TIER]:
+            if group == 'rhythm':
+                values.append(_tempo(self.onsets, self.sr))
+            else:
+                for moments in self.moments[group]:
+                    values.extend([moments.mean, moments.std])
+        return np.concatenate(values).astype(FEATURE_DTYPE).reshape(1, -1)
+
+    # True when everything since the last call was below is_silent's threshold
+    def take_silent(self):
+        silent = self.peak < 0.001
+        self.peak = 0.0
+        return silent
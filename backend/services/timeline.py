@@ -0,0 +1,121 @@
+import os
+import numpy as np
+from services.getfeatures import (
+    FEATURE_DTYPE, FEATURE_TIERS, HOP_LENGTH, _tempo, frame_features, is_silent, load_audio
+)
+from services.metrics import span
+
+# Timeline settings, overridable per deployment
+TIMELINE_MAX_SECONDS = float(os.environ.get('TIMELINE_MAX_SECONDS', 600))  # longer tracks are cut here
+# audio whose frame features are held at once (STFT, HPSS, mel...), ~600 MB peak at 180 s;
+# a longer track is analyzed in segments of consecutive windows
+TIMELINE_SEGMENT_SECONDS = float(os.environ.get('TIMELINE_SEGMENT_SECONDS', 180))
+TIMELINE_WINDOW = 45  # seconds per window, the clip length the models were trained on
+TIMELINE_HOP = 15
+
+
+# window start samples every `hop`, plus one more aligned to the end so the tail is covered;
+# a track shorter than one window is a single window over all of it
+def window_starts(n_samples, window_samples, hop_samples):
+    last = max(n_samples - window_samples, 0)
+    starts = np.arange(0, last + 1, hop_samples)
+    if starts[-1] != last:
+        starts = np.append(starts, last)
+    return starts
+
+
+# mean and std over frames [lo, lo + n) of every row, for all windows at once, from running
+# sums of x and x^2. Rows are centered first so the running sums don't lose precision
+def _rolling_mean_std(x, lo, n):
+    x = np.asarray(x, dtype=np.float64)
+    center = x.mean(axis=1, keepdims=True)
+    x = x - center
+    zeros = np.zeros((len(x), 1))
+    s1 = np.concatenate([zeros, np.cumsum(x, axis=1)], axis=1)
+    s2 = np.concatenate([zeros, np.cumsum(x * x, axis=1)], axis=1)
+    hi = np.minimum(lo + n, x.shape[1])
+    n = hi - lo
+    mean = (s1[:, hi] - s1[:, lo]) / n
+    var = np.maximum((s2[:, hi] - s2[:, lo]) / n - mean ** 2, 0.0)
+    return (mean + center).T, np.sqrt(var).T
+
+
+# running sum of a sample array, for the window means of the harmonic/percussive ratios
+def _window_means(x, starts, window_samples):
+    total = np.concatenate([[0.0], np.cumsum(x, dtype=np.float64)])
+    ends = np.minimum(starts + window_samples, len(x))
+    return (total[ends] - total[starts]) / (ends - starts)
+
+
+# (n_windows, features) matrix for overlapping windows over y, laid out like
+# extract_features. The per-frame work runs once per segment of at most
+# TIMELINE_SEGMENT_SECONDS (or one window) and each window is summarized from it, so the
+# cost barely grows with the number of windows and memory doesn't grow with the track.
+#
+# Not bit-identical to extract_features on the window's slice: what librosa derives from
+# the whole input it's given (the mel dB floor, 80 dB under the loudest frame; the tuning
+# estimate of the chroma and tonnetz; the HPSS median filters and frame padding at the
+# edges) comes from the segment instead of the window. scripts/check_timeline_parity.py
+# reports the difference
+def timeline_features(y, sr=22050, window=TIMELINE_WINDOW, hop=TIMELINE_HOP, tier='full',
+                      segment=TIMELINE_SEGMENT_SECONDS):
+    window_samples = int(window * sr)
+    segment_samples = max(int(segment * sr), window_samples)
+    starts = window_starts(len(y), window_samples, max(1, int(hop * sr)))
+
+    rows = []
+    first = 0
+    while first < len(starts):
+        # every window that ends inside a segment starting where the first one does
+        last = first + 1
+        while last < len(starts) and starts[last] + window_samples <= starts[first] + segment_samples:
+            last += 1
+        lo, hi = starts[first], min(starts[last - 1] + window_samples, len(y))
+        rows.append(_segment_features(y[lo:hi], starts[first:last] - lo, window_samples, sr, tier))
+        first = last
+
+    ends = np.minimum(starts + window_samples, len(y))
+    return starts / sr, ends / sr, np.vstack(rows)
+
+
+# the windows at `starts` (samples into y) summarized from one frame_features pass over y
+def _segment_features(y, starts, window_samples, sr, tier):
+    frames = frame_features(y, sr=sr, tier=tier)
+
+    # same frames a clip of the window's length would have, 1 + samples // hop
+    lo = starts // HOP_LENGTH
+    n = 1 + min(window_samples, len(y)) // HOP_LENGTH
+
+    columns = []
+    with span('timeline.windows'):
+        for group in FEATURE_TIERS[tier]:
+            if group == 'rhythm':
+                onset_env = frames[group]
+                columns.append(np.array([_tempo(onset_env[f:f + n], sr)[0] for f in lo])[:, np.newaxis])
+            elif group == 'harmonic_percussive':
+                abs_y, abs_harmonic, abs_percussive = frames[group]
+                energy = _window_means(abs_y, starts, window_samples) + 1e-6
+                columns.append(np.column_stack([
+                    _window_means(abs_harmonic, starts, window_samples) / energy,
+                    _window_means(abs_percussive, starts, window_samples) / energy,
+                ]))
+            else:
+                for part in frames[group]:
+                    columns.extend(_rolling_mean_std(part, lo, n))
+    return np.hstack(columns).astype(FEATURE_DTYPE)
+
+
+# decodes the whole track (up to TIMELINE_MAX_SECONDS), returns (starts, ends, features)
+# in seconds and (n_windows, features), or None
+def get_timeline(audio_file, window=TIMELINE_WINDOW, hop=TIMELINE_HOP, sr=22050, tier='full'):
+    try:
+        y = load_audio(audio_file, duration=TIMELINE_MAX_SECONDS, sr=sr)
+
+        if is_silent(y):
+            return None
+
+        return timeline_features(y, sr=sr, window=window, hop=hop, tier=tier)
+
+    except Exception as e:
+        print(f"Timeline extraction failed: {e}")
+        return None
@@ -0,0 +1,169 @@
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+from services.getfeatures import FEATURE_NAMES, FEATURE_SCHEMA_VERSION, FeatureSchemaError
+
+# Vector store settings, overridable per deployment
+VECTOR_STORE_DIR = os.environ.get('VECTOR_STORE_DIR')  # unset keeps no vectors
+ID_LENGTH = 16  # hex characters of the audio key that make a song's ID
+BLOCK_ROWS = 65536  # rows searched together, bounds the work arrays
+RERANK = 4  # approximate float32 distances pick RERANK * k + 16 rows, re-ranked exactly
+
+
+# the short song ID for an audio key from services.cache.audio_key
+def song_id(key):
+    return key[:ID_LENGTH] if key else None
+
+
+# Full-tier feature vectors of every analyzed song, for similarity search. Vectors and
+# (valence, arousal) are appended to raw float32 files that are memory-mapped for search,
+# so the store can be far larger than RAM; songs.row in ids.sqlite3 is the row in both files.
+# A crash between appending a vector and committing its ID leaves extra bytes at the end,
+# which are cut off on the next open. Raw vectors are kept rather than scaled ones, so a
+# retrained scaler applies to everything already stored
+class VectorStore:
+    def __init__(self, path, dims=len(FEATURE_NAMES)):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dims = dims
+        self._files = {'vectors': (os.path.join(path, 'vectors.f32'), dims), 'moods': (os.path.join(path, 'moods.f32'), 2)}
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._norms = (None, np.zeros(0, dtype=np.float32))  # (scales they were computed with, norms)
+
+        self._db = sqlite3.connect(os.path.join(path, 'ids.sqlite3'), check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS songs (row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, name TEXT, added_at REAL)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('schema_version', ?), ('dims', ?)",
+                             (str(FEATURE_SCHEMA_VERSION), str(dims)))
+        meta = dict(self._db.execute("SELECT key, value FROM meta"))
+        if int(meta['schema_version']) != FEATURE_SCHEMA_VERSION or int(meta['dims']) != dims:
+            raise FeatureSchemaError(
+                f"Vector store {path} holds feature schema v{meta['schema_version']} vectors, "
+                f"the extractor is v{FEATURE_SCHEMA_VERSION}; move it aside to start a new one"
+            )
+
+        self.count = self._db.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+        for file_path, width in self._files.values():
+            with open(file_path, 'ab'):
+                pass
+            os.truncate(file_path, self.count * width * 4)
+
+    def __len__(self):
+        return self.count
+
+    # adds (id, features, valence, arousal, name) songs, skipping IDs already stored;
+    # returns how many were new
+    def add(self, songs):
+        with self._lock:
+            ids = [song[0] for song in songs]
+            known = {row[0] for row in self._db.execute(
+                f"SELECT id FROM songs WHERE id IN ({','.join('?' * len(ids))})", ids
+            )}
+            new = []
+            for song in songs:
+                if song[0] not in known:
+                    known.add(song[0])
+                    new.append(song)
+            if not new:
+                return 0
+
+            vectors = np.array([np.ravel(features) for _, features, _, _, _ in new], dtype='<f4')
+            moods = np.array([(valence, arousal) for _, _, valence, arousal, _ in new], dtype='<f4')
+            for name, array in (('vectors', vectors), ('moods', moods)):
+                with open(self._files[name][0], 'ab') as f:
+                    f.write(array.tobytes())
+            now = time.time()
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO songs VALUES (?, ?, ?, ?)",
+                    [(self.count + i, song[0], song[4], now) for i, song in enumerate(new)]
+                )
+            self.count += len(new)
+            return len(new)
+
+    def row(self, song_id):
+        found = self._db.execute("SELECT row FROM songs WHERE id = ?", (song_id,)).fetchone()
+        return found[0] if found else None
+
+    def __contains__(self, song_id):
+        return self.row(song_id) is not None
+
+    # read-only maps of the first `count` rows, remapped once the files have grown
+    def _array(self, name, count):
+        mapped = self._maps.get(name)
+        if mapped is None or len(mapped) < count:
+            file_path, width = self._files[name]
+            if count == 0:
+                return np.zeros((0, width), dtype='<f4')
+            mapped = np.memmap(file_path, dtype='<f4', mode='r', shape=(count, width))
+            self._maps[name] = mapped
+        return mapped[:count]
+
+    def vector(self, row):
+        return np.array(self._array('vectors', row + 1)[row]), np.array(self._array('moods', row + 1)[row])
+
+    # sum of (x / scale)^2 per stored vector, extended as rows are added, recomputed when
+    # the scales change (a retrained scaler)
+    def _scaled_norms(self, vectors, weights):
+        with self._lock:
+            cached_weights, norms = self._norms
+            if cached_weights is None or not np.array_equal(cached_weights, weights):
+                norms = np.zeros(0, dtype=np.float32)
+            for start in range(len(norms), len(vectors), BLOCK_ROWS):
+                block = np.asarray(vectors[start:start + BLOCK_ROWS], dtype=np.float32)
+                norms = np.concatenate([norms, (block * block) @ weights])
+            self._norms = (weights, norms)
+            return norms[:len(vectors)]
+
+    # the k stored songs nearest to `query`: a raw feature vector in 'features' space (compared
+    # after scaling by `scales`, the full-tier scaler's), a (valence, arousal) pair in 'mood' space.
+    # Returns [(row, distance)], nearest first
+    def nearest(self, query, k=10, space='features', scales=None, exclude=None):
+        count = self.count
+        query = np.ravel(np.asarray(query, dtype=np.float64))
+        if space == 'mood':
+            data = self._array('moods', count)
+            weights = np.ones(2)
+        else:
+            data = self._array('vectors', count)
+            weights = 1 / np.asarray(scales, dtype=np.float64) ** 2
+        pick = min(count, RERANK * k + 16 + (exclude is not None))
+
+        # squared distances as |x|^2 - 2 x.q + |q|^2 with the weights folded in, one
+        # matrix-vector product per block; the best rows of every block are kept
+        candidates = []
+        if space == 'features':
+            norms = self._scaled_norms(data, weights.astype(np.float32))
+        for start in range(0, count, BLOCK_ROWS):
+            block = np.asarray(data[start:start + BLOCK_ROWS], dtype=np.float32)
+            if space == 'features':
+                d = norms[start:start + len(block)] - 2 * (block @ (weights * query).astype(np.float32))
+            else:
+                d = np.sum((block - query.astype(np.float32)) ** 2, axis=1)
+            best = np.argpartition(d, pick - 1)[:pick] if pick < len(d) else np.arange(len(d))
+            candidates.append(best + start)
+        if not candidates:
+            return []
+
+        # exact float64 distances for the shortlist
+        rows = np.sort(np.concatenate(candidates))
+        if exclude is not None:
+            rows = rows[rows != exclude]
+        exact = np.sqrt(((np.asarray(data[rows], dtype=np.float64) - query) ** 2) @ weights)
+        order = np.argsort(exact, kind='stable')[:k]
+        return [(int(rows[i]), float(exact[i])) for i in order]
+
+    # (id, name) per row
+    def describe(self, rows):
+        if not rows:
+            return {}
+        found = self._db.execute(
+            f"SELECT row, id, name FROM songs WHERE row IN ({','.join('?' * len(rows))})", list(rows)
+        )
+        return {row: (song_id, name) for row, song_id, name in found}
@@ -1,13 +1,23 @@
 import os
+import re
 import math
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
+from services.metrics import span
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 BASE_GRAPH_PATH = os.path.join(BASE_DIR, 'assets', 'valence_arousal_base.png')
-OUTPUT_SIZE = 800  # resize before encoding — original is 2379x2379
+OUTPUT_SIZE = 800  # original is 2379x2379, resized once at load
 
-_base_graph = Image.open(BASE_GRAPH_PATH).convert('RGBA')
+# Output settings, overridable per deployment
+PLOT_FORMAT = os.environ.get('PLOT_FORMAT', 'png').lower()  # 'png' or 'webp'
+PNG_COMPRESS_LEVEL = int(os.environ.get('PLOT_PNG_COMPRESS_LEVEL', 6))  # 1 encodes ~2x faster, ~30% larger
+WEBP_QUALITY = int(os.environ.get('PLOT_WEBP_QUALITY', 85))
+RENDER_CACHE_SIZE = int(os.environ.get('PLOT_CACHE_SIZE', 128))
+
+with Image.open(BASE_GRAPH_PATH) as _header:  # reads the size only, pixels are decoded on first render
+    BASE_SIZE = _header.width
 
 # These define the plot area within the image (in pixels)
 # Image is 2379x2379, center (0.5, 0.5) is at pixel (1050, 1237)
@@ -16,43 +26,50 @@ PLOT_RIGHT = 1975
 PLOT_TOP = 312
 PLOT_BOTTOM = 2162
 
-def visualize_emotion(valence: float, arousal: float) -> BytesIO:
-    img = _base_graph.copy()
-    draw = ImageDraw.Draw(img)
+# The overlay is drawn SUPERSAMPLE times larger than the output on a small transparent
+# layer, then downsampled and composited, so edges stay as smooth as the full-size render
+SCALE = OUTPUT_SIZE / BASE_SIZE
+SUPERSAMPLE = 3
+PLOT_WIDTH_PX = (PLOT_RIGHT - PLOT_LEFT) * SCALE
+PLOT_HEIGHT_PX = (PLOT_BOTTOM - PLOT_TOP) * SCALE
+
+# Marker geometry in original-image pixels
+RADIUS = 25
+OFFSET = 120
+ARROW_SIZE = 20
+PADDING = 10
+LABEL = "YOUR SONG"
+
+try:
+    _font = ImageFont.load_default(size=round(36 * SCALE * SUPERSAMPLE))
+except:
+    _font = ImageFont.load_default()
+
+
+# decodes the base graph and resizes it once; only the output-size copy is kept in memory
+@lru_cache(maxsize=1)
+def load_base_graph():
+    with Image.open(BASE_GRAPH_PATH) as base_graph:
+        return base_graph.convert('RGBA').resize((OUTPUT_SIZE, OUTPUT_SIZE), Image.LANCZOS)
 
-    # Map valence (0-1) to x pixel coordinate
-    x = PLOT_LEFT + valence * (PLOT_RIGHT - PLOT_LEFT)
-    # Map arousal (0-1) to y pixel coordinate (inverted because y=0 is top in images)
-    y = PLOT_BOTTOM - arousal * (PLOT_BOTTOM - PLOT_TOP)
 
+def _draw_overlay(draw, x, y, text_x, text_y, s, label=LABEL):
     # Draw the point
-    radius = 25
+    radius = RADIUS * s
     draw.ellipse(
         [x - radius, y - radius, x + radius, y + radius],
         fill='red',
         outline='darkred',
-        width=3
+        width=max(1, round(3 * s))
     )
 
-    # Draw arrow and label
-    # Position label offset based on point location to stay in bounds
-    offset = 120
-    if valence > 0.7:
-        text_x = x - offset
-    else:
-        text_x = x + offset
-    if arousal > 0.7:
-        text_y = y + offset
-    else:
-        text_y = y - offset
-
     # Draw arrow line from text to point
     arrow_color = 'darkred'
-    draw.line([(text_x, text_y), (x, y)], fill=arrow_color, width=4)
+    draw.line([(text_x, text_y), (x, y)], fill=arrow_color, width=max(1, round(4 * s)))
 
     # Draw arrowhead
     angle = math.atan2(y - text_y, x - text_x)
-    arrow_size = 20
+    arrow_size = ARROW_SIZE * s
     arrow_angle = math.pi / 6  # 30 degrees
 
     x1 = x - arrow_size * math.cos(angle - arrow_angle)
@@ -63,24 +80,132 @@ def visualize_emotion(valence: float, arousal: float) -> BytesIO:
     draw.polygon([(x, y), (x1, y1), (x2, y2)], fill=arrow_color)
 
     # Draw text label with background
-    try:
-        font = ImageFont.load_default(size=36)
-    except:
-        font = ImageFont.load_default()
-
-    text = "YOUR SONG"
-    bbox = draw.textbbox((text_x, text_y), text, font=font, anchor="mm")
-    padding = 10
+    bbox = draw.textbbox((text_x, text_y), label, font=_font, anchor="mm")
+    padding = PADDING * s
     draw.rounded_rectangle(
         [bbox[0] - padding, bbox[1] - padding, bbox[2] + padding, bbox[3] + padding],
-        radius=8,
+        radius=8 * s,
         fill='white',
         outline='darkred',
-        width=2
+        width=max(1, round(2 * s))
     )
-    draw.text((text_x, text_y), text, fill='darkred', font=font, anchor="mm")
+    draw.text((text_x, text_y), label, fill='darkred', font=_font, anchor="mm")
+
+
+# timed as the 'render' stage on cache misses only, a memoized hit costs nothing
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render(px, py, fmt):
+    with span('render'):
+        return _render_uncached(px, py, fmt)
+
+
+def _render_uncached(px, py, fmt):
+    valence = px / PLOT_WIDTH_PX
+    arousal = py / PLOT_HEIGHT_PX
+
+    x, y = _point(valence, arousal)
+    text_x, text_y = _label_position(x, y, valence, arousal)
+
+    # Only the area around the marker and label gets drawn and composited
+    label_w, label_h = _font.getbbox(LABEL)[2:]
+    half_w = (label_w / SUPERSAMPLE) / 2 + (PADDING + 4) * SCALE
+    half_h = (label_h / SUPERSAMPLE) / 2 + (PADDING + 4) * SCALE
+    reach = (RADIUS + 4) * SCALE
+    left = max(0, math.floor(min(x - reach, text_x - half_w)))
+    top = max(0, math.floor(min(y - reach, text_y - half_h)))
+    right = min(OUTPUT_SIZE, math.ceil(max(x + reach, text_x + half_w)))
+    bottom = min(OUTPUT_SIZE, math.ceil(max(y + reach, text_y + half_h)))
+
+    layer = Image.new('RGBA', ((right - left) * SUPERSAMPLE, (bottom - top) * SUPERSAMPLE), (0, 0, 0, 0))
+    _draw_overlay(
+        ImageDraw.Draw(layer),
+        (x - left) * SUPERSAMPLE, (y - top) * SUPERSAMPLE,
+        (text_x - left) * SUPERSAMPLE, (text_y - top) * SUPERSAMPLE,
+        SCALE * SUPERSAMPLE
+    )
+    layer = layer.resize((right - left, bottom - top), Image.LANCZOS)
+
+    img = load_base_graph().copy()
+    img.alpha_composite(layer, (left, top))
+    return _encode(img, fmt)
+
+
+# (valence, arousal) to output pixels
+def _point(valence, arousal):
+    return PLOT_LEFT * SCALE + valence * PLOT_WIDTH_PX, PLOT_BOTTOM * SCALE - arousal * PLOT_HEIGHT_PX
 
+
+# Position label offset based on point location to stay in bounds
+def _label_position(x, y, valence, arousal):
+    offset = OFFSET * SCALE
+    text_x = x - offset if valence > 0.7 else x + offset
+    text_y = y + offset if arousal > 0.7 else y - offset
+    return text_x, text_y
+
+
+def _encode(img, fmt):
     buf = BytesIO()
-    img.resize((OUTPUT_SIZE, OUTPUT_SIZE), Image.LANCZOS).save(buf, format='PNG')
-    buf.seek(0)
-    return buf
\ No newline at end of file
+    if fmt == 'webp':
+        img.save(buf, format='WEBP', quality=WEBP_QUALITY)
+    else:
+        img.save(buf, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+def render_cache_info():
+    return _render.cache_info()
+
+
+def _quantize(valence, arousal):
+    return round(valence * PLOT_WIDTH_PX), round(arousal * PLOT_HEIGHT_PX)
+
+
+# Results are memoized per output pixel, the finest position the plot can show
+def visualize_emotion(valence: float, arousal: float, fmt: str = PLOT_FORMAT) -> BytesIO:
+    return BytesIO(_render(*_quantize(valence, arousal), fmt))
+
+
+# Short stable ID for a plot, e.g. "212-374.png"; the same point always gets the same ID
+def plot_id(valence: float, arousal: float, fmt: str = PLOT_FORMAT) -> str:
+    px, py = _quantize(valence, arousal)
+    return f"{px}-{py}.{fmt}"
+
+
+# Renders the plot behind an ID from plot_id, returns (image bytes, media type)
+def render_plot(plot_id: str) -> tuple[bytes, str]:
+    match = re.fullmatch(r"(\d+)-(\d+)\.(png|webp)", plot_id)
+    if match is None:
+        raise ValueError(f"Invalid plot id: {plot_id}")
+    px, py, fmt = int(match[1]), int(match[2]), match[3]
+    if px > round(PLOT_WIDTH_PX) or py > round(PLOT_HEIGHT_PX):
+        raise ValueError(f"Plot id out of range: {plot_id}")
+    return _render(px, py, fmt), f"image/{fmt}"
+
+
+# Mood trajectory of a timeline: the window points joined in time order, shading from
+# light to dark red, with the last one marked like a single-song plot. Every track draws
+# a different path, so these aren't memoized
+def visualize_trajectory(points, fmt: str = PLOT_FORMAT) -> BytesIO:
+    with span('render'):
+        s = SCALE * SUPERSAMPLE
+        layer = Image.new('RGBA', (OUTPUT_SIZE * SUPERSAMPLE, OUTPUT_SIZE * SUPERSAMPLE), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        xy = [tuple(c * SUPERSAMPLE for c in _point(valence, arousal)) for valence, arousal in points]
+
+        if len(xy) > 1:
+            draw.line(xy, fill=(139, 0, 0, 160), width=max(1, round(6 * s)), joint='curve')
+        radius = RADIUS * s / 2
+        for i, (x, y) in enumerate(xy[:-1]):
+            t = i / max(1, len(xy) - 2)
+            fill = (round(255 - 55 * t), round(200 * (1 - t)), round(200 * (1 - t)))
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=fill,
+                         outline='darkred', width=max(1, round(2 * s)))
+
+        valence, arousal = points[-1]
+        x, y = _point(valence, arousal)
+        text_x, text_y = _label_position(x, y, valence, arousal)
+        _draw_overlay(draw, x * SUPERSAMPLE, y * SUPERSAMPLE, text_x * SUPERSAMPLE, text_y * SUPERSAMPLE, s, label="END")
+
+        img = load_base_graph().copy()
+        img.alpha_composite(layer.resize((OUTPUT_SIZE, OUTPUT_SIZE), Image.LANCZOS))
+        return BytesIO(_encode(img, fmt))